@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
 from flask import Flask, render_template_string, request, jsonify, Response
-import subprocess
 import json
-import sys
 import time
-import re
 import os
+import gzip
+import shutil
+import threading
+from collections import deque
+from itertools import islice
 from pathlib import Path
 
+import rlog_downloader as downloader
+from rlog_downloader import SegmentStore, STATE_DB_FILE
+
 app = Flask(__name__)
 
 SCRIPT_DIR = Path(__file__).parent
@@ -22,10 +27,250 @@ else:
     UPLOADED_LOGS_FILE = SCRIPT_DIR / "uploaded_logs.json"
     LOG_FILE = SCRIPT_DIR / "rlog_monitor.log"
 
-SCRIPT_FILE = SCRIPT_DIR / "rlog_downloader.py"
 
-running_process = None
-log_position = 0
+# Monitor output kept in memory for /run subscribers, and how much of it a
+# new subscriber is shown first.
+LOG_BUFFER_LINES = 2000
+LOG_REPLAY_LINES = 50
+SSE_KEEPALIVE_INTERVAL = 15
+# LOG_FILE is gzipped into a numbered segment once it reaches
+# LOG_ROTATE_BYTES; the newest LOG_ROTATE_KEEP segments are kept. The active
+# file's index holds a byte offset every LOG_INDEX_STRIDE lines.
+LOG_ROTATE_BYTES = 1024 * 1024
+LOG_ROTATE_KEEP = 10
+LOG_INDEX_STRIDE = 200
+HISTORY_MAX_LINES = 1000
+# Most recent uploads kept for the /upload_stats throughput history
+UPLOAD_HISTORY_LENGTH = 100
+# Engine events (progress, stage timings, errors) kept for /events subscribers
+EVENT_BUFFER_SIZE = 500
+
+engine = None
+run_start_id = 0
+state_store = None
+
+
+class RotatingLog:
+    """Monitor log that rotates by size into gzip segments.
+
+    Lines are numbered from 1 across rotations. The index file records each
+    segment's first line and line count; together with the offsets kept for
+    the active file, a page of history is read without scanning the log.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_file = path.with_name(path.name + ".index.json")
+        self.lock = threading.Lock()
+        self.segments = []
+        try:
+            with open(self.index_file, 'r') as f:
+                self.segments = [seg for seg in json.load(f) if (path.parent / seg["file"]).exists()]
+        except (OSError, ValueError):
+            pass
+        self.active_first = self.segments[-1]["first"] + self.segments[-1]["lines"] if self.segments else 1
+        self.active_lines = 0
+        self.active_bytes = 0
+        self.offsets = []
+        if path.exists():
+            with open(path, 'rb') as f:
+                for line in f:
+                    self.index_line(len(line))
+                if self.active_bytes and not line.endswith(b"\n"):
+                    # Finish a line cut off by a crash so the next one starts fresh
+                    self.active_bytes += 1
+                    with open(path, 'ab') as out:
+                        out.write(b"\n")
+        self.file = open(path, 'ab')
+
+    def index_line(self, size):
+        if self.active_lines % LOG_INDEX_STRIDE == 0:
+            self.offsets.append(self.active_bytes)
+        self.active_lines += 1
+        self.active_bytes += size
+
+    @property
+    def oldest_line(self):
+        return self.segments[0]["first"] if self.segments else self.active_first
+
+    @property
+    def next_line(self):
+        return self.active_first + self.active_lines
+
+    def append(self, text):
+        """Write one line; returns its line number."""
+        data = (text + "\n").encode(errors="replace")
+        with self.lock:
+            line_number = self.next_line
+            self.file.write(data)
+            self.file.flush()
+            self.index_line(len(data))
+            if self.active_bytes >= LOG_ROTATE_BYTES:
+                self.rotate()
+            return line_number
+
+    def rotate(self):
+        self.file.close()
+        name = f"{self.path.name}.{self.active_first}.gz"
+        tmp_file = self.path.with_name(name + ".tmp")
+        with open(self.path, 'rb') as src, gzip.open(tmp_file, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_file, self.path.with_name(name))
+        self.segments.append({"file": name, "first": self.active_first, "lines": self.active_lines})
+        while len(self.segments) > LOG_ROTATE_KEEP:
+            (self.path.parent / self.segments.pop(0)["file"]).unlink(missing_ok=True)
+        tmp_index = self.index_file.with_name(self.index_file.name + ".tmp")
+        with open(tmp_index, 'w') as f:
+            json.dump(self.segments, f)
+        os.replace(tmp_index, self.index_file)
+
+        self.active_first = self.next_line
+        self.active_lines = 0
+        self.active_bytes = 0
+        self.offsets = []
+        self.file = open(self.path, 'wb')
+
+    def read(self, first, last):
+        """Return [(line_number, text)] for lines first <= n < last still on disk."""
+        with self.lock:
+            segments = list(self.segments)
+            active_first, active_lines, offsets = self.active_first, self.active_lines, list(self.offsets)
+        lines = []
+        for seg in segments:
+            start, end = max(first, seg["first"]), min(last, seg["first"] + seg["lines"])
+            if start >= end:
+                continue
+            try:
+                with gzip.open(self.path.parent / seg["file"], 'rt', errors='replace') as f:
+                    text = f.read().split("\n")
+            except OSError:
+                continue
+            lines.extend((n, text[n - seg["first"]]) for n in range(start, end))
+
+        start, end = max(first, active_first), min(last, active_first + active_lines)
+        if start < end:
+            stride_index = (start - active_first) // LOG_INDEX_STRIDE
+            with open(self.path, 'rb') as f:
+                f.seek(offsets[stride_index])
+                n = active_first + stride_index * LOG_INDEX_STRIDE
+                for raw in f:
+                    if n >= end:
+                        break
+                    if n >= start:
+                        lines.append((n, raw.decode(errors='replace').rstrip("\n")))
+                    n += 1
+        return lines
+
+    def history(self, before=None, limit=200):
+        """The `limit` lines before line `before` (default: the end of the log)."""
+        last = min(before or self.next_line, self.next_line)
+        return self.read(max(last - limit, self.oldest_line), last)
+
+
+monitor_log = RotatingLog(LOG_FILE)
+
+
+class LogBroadcaster:
+    """Ring buffer of monitor output (or engine events) shared by every subscriber.
+
+    Entries carry increasing ids, so a reconnecting EventSource resumes after
+    its Last-Event-ID as long as that entry is still buffered.
+    """
+
+    def __init__(self, max_lines):
+        self.entries = deque(maxlen=max_lines)
+        self.next_id = 1
+        self.condition = threading.Condition()
+
+    def publish(self, event_id, text, done=False):
+        with self.condition:
+            self.entries.append((event_id, text, done))
+            self.next_id = event_id + 1
+            self.condition.notify_all()
+
+    def last_id(self):
+        with self.condition:
+            return self.next_id - 1
+
+    def subscribe(self, after_id=None, timeout=SSE_KEEPALIVE_INTERVAL):
+        """Yield (id, text, done) entries after `after_id`, then new ones as they arrive.
+
+        Without `after_id` the last LOG_REPLAY_LINES entries are replayed
+        first. None is yielded after each idle `timeout` so the caller can
+        send a keepalive.
+        """
+        with self.condition:
+            if after_id is None or after_id >= self.next_id:
+                after_id = max(self.next_id - 1 - LOG_REPLAY_LINES, 0)
+        while True:
+            with self.condition:
+                if after_id >= self.next_id - 1:
+                    self.condition.wait(timeout)
+                first_id = self.entries[0][0] if self.entries else self.next_id
+                pending = list(islice(self.entries, max(after_id + 1 - first_id, 0), None))
+            if not pending:
+                yield None
+                continue
+            for entry in pending:
+                after_id = entry[0]
+                yield entry
+
+
+# Event ids are monitor log line numbers, so they stay valid across restarts
+# and the page can fetch whatever scrolled out of the buffer from /history.
+log_broadcaster = LogBroadcaster(LOG_BUFFER_LINES)
+log_broadcaster.next_id = monitor_log.next_line
+event_broadcaster = LogBroadcaster(EVENT_BUFFER_SIZE)
+output_lock = threading.Lock()
+
+
+def publish_output(text, done=False):
+    with output_lock:
+        log_broadcaster.publish(monitor_log.append(text), text, done)
+
+
+def publish_event(event):
+    with output_lock:
+        event_broadcaster.publish(event_broadcaster.last_id() + 1, json.dumps(event))
+
+
+def pump_events(engine):
+    """Move engine events into the monitor log (log lines) and to /events subscribers (the rest)."""
+    while True:
+        event = engine.events.get()
+        if event is None:
+            break
+        if event["type"] == "log":
+            for line in event["message"].split("\n"):
+                publish_output(line)
+        else:
+            publish_event(event)
+    publish_output("Monitor stopped", done=True)
+
+
+def engine_running():
+    return engine is not None and engine.is_running()
+
+
+def stream_log(after_id=None, broadcaster=log_broadcaster):
+    for entry in broadcaster.subscribe(after_id):
+        if entry is None:
+            yield ": keepalive\n\n"
+            continue
+        event_id, text, done = entry
+        yield f"id: {event_id}\ndata: {text}\n\n"
+        if done:
+            yield "data: [DONE]\n\n"
+            return
+
+
+def replay_log(after_id):
+    """Send the logged lines after `after_id`, then end the stream; for when nothing is running."""
+    last = monitor_log.next_line
+    for line_number, text in monitor_log.read(max(after_id + 1, last - LOG_BUFFER_LINES), last):
+        yield f"id: {line_number}\ndata: {text}\n\n"
+    yield "data: [DONE]\n\n"
+
 
 DEFAULT_CONFIG = {
     "comma_ip": "192.168.173.10",
@@ -62,6 +307,12 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         button.stop:hover { background: #da190b; }
         #output { background: #0a0a0a; border: 1px solid #333; border-radius: 4px; padding: 15px; font-family: 'Courier New', monospace; font-size: 13px; min-height: 400px; max-height: 600px; overflow-y: auto; white-space: pre-wrap; word-wrap: break-word; color: #00ff00; display: none; margin-top: 20px; }
         #output.active { display: block; }
+        #progress { margin-top: 20px; font-size: 13px; color: #d0d0d0; }
+        .progress-row { margin-top: 8px; }
+        .progress-label { display: flex; justify-content: space-between; gap: 10px; }
+        .progress-bar { height: 6px; background: #333; border-radius: 3px; overflow: hidden; margin-top: 3px; }
+        .progress-fill { height: 100%; width: 0; background: #2196F3; transition: width 0.3s; }
+        #stages { color: #888; }
         .status { padding: 10px 15px; border-radius: 4px; margin-top: 15px; display: none; }
         .status.running { background: #1a4d2e; color: #4CAF50; display: block; }
         .status.error { background: #4d1a1a; color: #f44336; display: block; }
@@ -120,10 +371,11 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         <div class="section">
             <div class="stats">
                 📊 <strong>Uploaded Routes:</strong> <span id="uploaded_count">{{ uploaded_count }}</span>
+                <span id="upload_details"></span>
             </div>
 
             <div class="buttons" style="margin-top: 15px;">
-                <button onclick="window.updateScript()">💾 Update Script & Save</button>
+                <button onclick="window.saveConfig()">💾 Save Settings</button>
                 <button onclick="window.startMonitoring()" id="startBtn">🚀 Start Monitoring</button>
                 <button onclick="window.startMonitoring()" id="viewLogsBtn" style="display: none;">👁️ View Live Logs</button>
                 <button onclick="window.stopMonitoring()" id="stopBtn" class="stop" style="display: none;">🛑 Stop Monitoring</button>
@@ -131,15 +383,21 @@ HTML_TEMPLATE = """<!DOCTYPE html>
             </div>
 
             <div id="status" class="status"></div>
+            <div id="progress"><div id="stages"></div></div>
+            <button onclick="window.loadEarlier()" id="loadEarlierBtn" style="display: none; margin-top: 20px;">⏫ Load Earlier Output</button>
             <div id="output"></div>
         </div>
     </div>
 
     <script type="text/javascript">
         var eventSource = null;
+        var engineEvents = null;
+        var progressRows = {};
+        var stageTimes = {};
+        var oldestShownId = null;
         var AUTO_START = {{ auto_start_js|safe }};
 
-        window.updateScript = function() {
+        window.saveConfig = function() {
             var config = {
                 comma_ip: document.getElementById('comma_ip').value,
                 comma_user: document.getElementById('comma_user').value,
@@ -150,7 +408,7 @@ HTML_TEMPLATE = """<!DOCTYPE html>
                 auto_start: document.getElementById('auto_start').checked
             };
 
-            fetch('/update_script', {
+            fetch('/save_config', {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify(config)
@@ -158,7 +416,7 @@ HTML_TEMPLATE = """<!DOCTYPE html>
             .then(function(r) { return r.json(); })
             .then(function(data) {
                 if (data.success) {
-                    showStatus('Script updated and configuration saved!', 'success');
+                    showStatus('Configuration saved!', 'success');
                     setTimeout(function() { hideStatus(); }, 2000);
                 } else {
                     showStatus('Error: ' + (data.error || 'Unknown error'), 'error');
@@ -180,40 +438,134 @@ HTML_TEMPLATE = """<!DOCTYPE html>
             stopBtn.style.display = 'block';
             output.innerHTML = 'Connecting to monitor...\\n';
             output.classList.add('active');
+            oldestShownId = null;
+            document.getElementById('loadEarlierBtn').style.display = 'block';
             showStatus('Monitoring...', 'running');
+            resetProgress();
 
             eventSource = new EventSource('/run');
+            openEngineEvents();
 
             eventSource.onmessage = function(event) {
                 if (event.data === '[DONE]' || event.data === '[ERROR]') {
                     eventSource.close();
                     eventSource = null;
+                    closeEngineEvents();
                     // Check status to determine which button to show
                     checkStatus();
                     showStatus(event.data === '[DONE]' ? 'Stopped' : 'Error occurred', event.data === '[DONE]' ? 'success' : 'error');
                     updateUploadCount();
                 } else {
+                    if (event.lastEventId && oldestShownId === null) {
+                        oldestShownId = parseInt(event.lastEventId, 10);
+                    }
                     output.innerHTML += event.data + '\\n';
                     output.scrollTop = output.scrollHeight;
                 }
             };
 
+            eventSource.onopen = function() {
+                showStatus('Monitoring...', 'running');
+            };
+
             eventSource.onerror = function() {
-                if (eventSource) {
-                    eventSource.close();
-                    eventSource = null;
+                // The browser retries on its own, resuming after the last event id
+                if (eventSource && eventSource.readyState !== EventSource.CLOSED) {
+                    showStatus('Connection lost, reconnecting...', 'running');
+                    return;
                 }
+                eventSource = null;
+                closeEngineEvents();
                 // Check status to determine which button to show
                 checkStatus();
                 showStatus('Connection closed', 'success');
             };
         };
 
+        function openEngineEvents() {
+            closeEngineEvents();
+            engineEvents = new EventSource('/events');
+            engineEvents.onmessage = function(message) {
+                var event = JSON.parse(message.data);
+                if (event.type === 'segment_started') {
+                    updateProgress(event.stage, event.file, event.resumed_from, event.size, null);
+                } else if (event.type === 'bytes_progress') {
+                    updateProgress(event.stage, event.file, event.done, event.total, event.rate);
+                } else if (event.type === 'stage_done') {
+                    stageTimes[event.stage] = event.seconds;
+                    document.getElementById('stages').textContent = Object.keys(stageTimes).map(function(stage) {
+                        return stage + ' ' + stageTimes[stage].toFixed(1) + 's';
+                    }).join(' · ');
+                } else if (event.type === 'error') {
+                    showStatus(event.message, 'error');
+                }
+            };
+        }
+
+        function closeEngineEvents() {
+            if (engineEvents) {
+                engineEvents.close();
+                engineEvents = null;
+            }
+        }
+
+        function resetProgress() {
+            progressRows = {};
+            stageTimes = {};
+            document.getElementById('progress').innerHTML = '<div id="stages"></div>';
+        }
+
+        function updateProgress(stage, file, done, total, rate) {
+            var key = stage + ':' + file;
+            var row = progressRows[key];
+            if (!row) {
+                row = document.createElement('div');
+                row.className = 'progress-row';
+                row.innerHTML = '<div class="progress-label"><span></span><span></span></div>' +
+                    '<div class="progress-bar"><div class="progress-fill"></div></div>';
+                row.querySelector('span').textContent = stage + ' ' + file;
+                document.getElementById('progress').appendChild(row);
+                progressRows[key] = row;
+            }
+            var percent = total ? Math.min(100, 100 * done / total) : 0;
+            row.querySelector('.progress-fill').style.width = percent.toFixed(1) + '%';
+            var detail = (done / (1024 * 1024)).toFixed(1) + '/' + (total / (1024 * 1024)).toFixed(1) + ' MB';
+            if (rate) {
+                detail += ' · ' + (rate / (1024 * 1024)).toFixed(2) + ' MB/s';
+            }
+            row.querySelectorAll('span')[1].textContent = detail;
+            if (total && done >= total) {
+                delete progressRows[key];
+                setTimeout(function() { row.remove(); }, 3000);
+            }
+        }
+
+        window.loadEarlier = function() {
+            var url = '/history?limit=200' + (oldestShownId !== null ? '&before=' + oldestShownId : '');
+            fetch(url)
+                .then(function(r) { return r.json(); })
+                .then(function(data) {
+                    if (!data.lines.length) {
+                        document.getElementById('loadEarlierBtn').style.display = 'none';
+                        return;
+                    }
+                    var output = document.getElementById('output');
+                    var height = output.scrollHeight;
+                    output.insertAdjacentText('afterbegin', data.lines.map(function(l) { return l.text; }).join('\\n') + '\\n');
+                    output.scrollTop += output.scrollHeight - height;
+                    oldestShownId = data.lines[0].id;
+                    if (!data.more) {
+                        document.getElementById('loadEarlierBtn').style.display = 'none';
+                    }
+                });
+        };
+
         window.stopMonitoring = function() {
             if (eventSource) {
                 eventSource.close();
                 eventSource = null;
             }
+            closeEngineEvents();
 
             fetch('/stop', { method: 'POST' })
                 .then(function(r) { return r.json(); })
@@ -240,10 +592,24 @@ HTML_TEMPLATE = """<!DOCTYPE html>
         };
 
         function updateUploadCount() {
-            fetch('/upload_count')
+            fetch('/upload_stats')
                 .then(function(r) { return r.json(); })
                 .then(function(data) {
                     document.getElementById('uploaded_count').textContent = data.count;
+                    var details = '';
+                    if (data.bytes) {
+                        details += ' · ' + (data.bytes / (1024 * 1024)).toFixed(1) + ' MB';
+                    }
+                    if (data.bytes_per_second) {
+                        details += ' · ' + (data.bytes_per_second / (1024 * 1024)).toFixed(2) + ' MB/s';
+                    }
+                    if (data.last_upload) {
+                        details += ' · last upload ' + new Date(data.last_upload * 1000).toLocaleString();
+                    }
+                    if (data.outbox.archives) {
+                        details += ' · ' + data.outbox.archives + ' archives waiting to retry';
+                    }
+                    document.getElementById('upload_details').textContent = details;
                 });
         }
 
@@ -327,74 +693,126 @@ def index():
     )
 
 def save_config_to_file(config):
-    with open(CONFIG_FILE, 'w') as f:
+    # Replace atomically so the downloader never reads a half-written file
+    tmp_file = CONFIG_FILE.with_name(CONFIG_FILE.name + ".tmp")
+    with open(tmp_file, 'w') as f:
         json.dump(config, f, indent=2)
+    os.replace(tmp_file, CONFIG_FILE)
+
+
+def get_state_store():
+    global state_store
+    if state_store is None:
+        state_store = SegmentStore(STATE_DB_FILE)
+    return state_store
+
+
+class UploadStats:
+    """Upload statistics kept in memory between requests.
+
+    The snapshot is rebuilt only after the state database, its WAL or the
+    legacy tracking file changes on disk, or after invalidate(). Rows of the
+    uploads table are folded into the throughput history as they appear
+    instead of being re-read on every rebuild.
+    """
+
+    def __init__(self, history_length):
+        self.lock = threading.Lock()
+        self.signature = None
+        self.snapshot = None
+        self.history = deque(maxlen=history_length)
+        self.last_upload_id = 0
+
+    def file_signature(self):
+        signature = []
+        for path in (STATE_DB_FILE, STATE_DB_FILE.with_name(STATE_DB_FILE.name + "-wal"), UPLOADED_LOGS_FILE):
+            try:
+                st = path.stat()
+                signature.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def invalidate(self):
+        with self.lock:
+            self.signature = None
+            self.history.clear()
+            self.last_upload_id = 0
+
+    def get(self):
+        signature = self.file_signature()
+        with self.lock:
+            if self.snapshot is None or signature != self.signature:
+                try:
+                    self.snapshot = self.build()
+                    self.signature = signature
+                except Exception as e:
+                    print(f"Warning: Failed to read upload stats: {e}")
+            return self.snapshot or self.build_empty()
+
+    def build_empty(self):
+        return {"count": 0, "bytes": 0, "last_upload": None, "dongles": {},
+                "history": [], "bytes_per_second": None,
+                "outbox": {"archives": 0, "bytes": 0, "next_attempt_at": None}}
+
+    def build(self):
+        store = get_state_store()
+        if store.latest_upload_id() < self.last_upload_id:
+            # The uploads table was cleared or replaced underneath us
+            self.history.clear()
+            self.last_upload_id = 0
+        for upload in store.uploads_since(self.last_upload_id):
+            upload["bytes_per_second"] = upload["bytes"] / upload["seconds"] if upload["seconds"] > 0 else None
+            self.history.append(upload)
+            self.last_upload_id = upload["id"]
+
+        dongles = {
+            dongle_id: {"count": count, "bytes": size, "last_upload": last_upload}
+            for dongle_id, (count, size, last_upload) in store.upload_totals().items()
+        }
+        snapshot = self.build_empty()
+        snapshot["dongles"] = dongles
+        snapshot["count"] = sum(d["count"] for d in dongles.values())
+        snapshot["bytes"] = sum(d["bytes"] for d in dongles.values())
+        snapshot["last_upload"] = max((d["last_upload"] for d in dongles.values() if d["last_upload"]), default=None)
+        snapshot["history"] = list(self.history)
+        outbox = store.outbox_entries()
+        snapshot["outbox"] = {
+            "archives": len(outbox),
+            "bytes": sum(entry["size"] for entry in outbox),
+            "next_attempt_at": min((e["next_attempt_at"] for e in outbox if e["next_attempt_at"]), default=None)
+        }
+        timed = [u for u in self.history if u["seconds"] > 0]
+        if timed:
+            snapshot["bytes_per_second"] = sum(u["bytes"] for u in timed) / sum(u["seconds"] for u in timed)
 
+        # Routes from a tracking file the downloader has not migrated yet
+        if UPLOADED_LOGS_FILE.exists():
+            with open(UPLOADED_LOGS_FILE, 'r') as f:
+                data = json.load(f)
+            snapshot["count"] += len(data) if isinstance(data, list) else 0
+        return snapshot
 
-def update_script_file(config):
-    if not SCRIPT_FILE.exists():
-        return False, "Script file not found"
 
-    try:
-        with open(SCRIPT_FILE, 'r') as f:
-            script_content = f.read()
-
-        script_content = re.sub(
-            r'COMMA_IP = "[^"]*"',
-            f'COMMA_IP = "{config["comma_ip"]}"',
-            script_content
-        )
-        script_content = re.sub(
-            r'BASE_URL = "[^"]*"',
-            f'BASE_URL = "{config["base_url"]}"',
-            script_content
-        )
-        script_content = re.sub(
-            r'UPLOAD_PATH = "[^"]*"',
-            f'UPLOAD_PATH = "{config["upload_path"]}"',
-            script_content
-        )
-        script_content = re.sub(
-            r'USERNAME = "[^"]*"',
-            f'USERNAME = "{config["fb_username"]}"',
-            script_content
-        )
-        script_content = re.sub(
-            r'PASSWORD = "[^"]*"',
-            f'PASSWORD = "{config["fb_password"]}"',
-            script_content
-        )
-
-        with open(SCRIPT_FILE, 'w') as f:
-            f.write(script_content)
-
-        return True, "Script updated successfully"
-    except Exception as e:
-        return False, str(e)
+upload_stats = UploadStats(UPLOAD_HISTORY_LENGTH)
 
 
 def get_uploaded_count():
-    if UPLOADED_LOGS_FILE.exists():
-        try:
-            with open(UPLOADED_LOGS_FILE, 'r') as f:
-                data = json.load(f)
-                return len(data) if isinstance(data, list) else 0
-        except Exception as e:
-            print(f"Warning: Failed to read upload count: {e}")
-            return 0
-    return 0
-
-@app.route('/update_script', methods=['POST'])
-def update_script_route():
-    config = request.json
-
-    success, message = update_script_file(config)
+    return upload_stats.get()["count"]
 
-    if success:
+@app.route('/save_config', methods=['POST'])
+def save_config_route():
+    config = load_config()
+    config.update({key: value for key, value in request.json.items() if key in DEFAULT_CONFIG})
+    try:
         save_config_to_file(config)
-        return jsonify({"success": True, "message": message})
-    else:
-        return jsonify({"success": False, "error": message})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+    # A running engine applies the changed settings without restarting
+    if engine_running():
+        engine.reload_config()
+    return jsonify({"success": True, "message": "Configuration saved"})
 
 
 @app.route('/upload_count')
@@ -402,101 +820,115 @@ def upload_count():
     return jsonify({"count": get_uploaded_count()})
 
 
+@app.route('/upload_stats')
+def upload_stats_route():
+    """Uploaded routes and bytes, in total and per dongle, plus recent upload throughput."""
+    return jsonify(upload_stats.get())
+
+
 @app.route('/status')
 def status():
-    global running_process
-    is_running = running_process is not None and running_process.poll() is None
     return jsonify({
-        "running": is_running,
+        "running": engine_running(),
         "log_exists": LOG_FILE.exists()
     })
 
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: the engine's metrics plus whether it is running."""
+    body = downloader.metrics.render() + (
+        "# HELP rlog_downloader_running 1 while the downloader engine is running.\n"
+        "# TYPE rlog_downloader_running gauge\n"
+        f"rlog_downloader_running {int(engine_running())}\n"
+        "# HELP rlog_uploaded_routes Distinct routes with a file recorded as uploaded.\n"
+        "# TYPE rlog_uploaded_routes gauge\n"
+        f"rlog_uploaded_routes {get_uploaded_count()}\n"
+    )
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
+    get_state_store().clear()
     if UPLOADED_LOGS_FILE.exists():
         UPLOADED_LOGS_FILE.unlink()
+    upload_stats.invalidate()
     return jsonify({"success": True})
 
 
 @app.route('/stop', methods=['POST'])
 def stop_route():
-    global running_process
-    if running_process and running_process.poll() is None:
-        try:
-            running_process.terminate()
-            running_process.wait(timeout=5)
-        except:
-            pass
-        running_process = None
+    if engine_running():
+        engine.stop()
     return jsonify({"success": True})
 
 
+@app.route('/history')
+def history():
+    """Page backwards through the monitor log: up to `limit` lines before line `before`."""
+    before = request.args.get('before', type=int)
+    limit = max(1, min(request.args.get('limit', 200, type=int), HISTORY_MAX_LINES))
+    lines = monitor_log.history(before, limit)
+    return jsonify({
+        "lines": [{"id": n, "text": text} for n, text in lines],
+        "more": bool(lines) and lines[0][0] > monitor_log.oldest_line
+    })
+
+
+def start_engine():
+    global engine
+    engine = downloader.Engine(store=get_state_store())
+    engine.start()
+    threading.Thread(target=pump_events, args=(engine,), daemon=True).start()
+
+
+@app.route('/events')
+def events():
+    """Engine events as JSON: segment_started, bytes_progress, stage_done and error."""
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        last_event_id = None
+    return Response(stream_log(last_event_id, event_broadcaster), mimetype='text/event-stream')
+
+
 @app.route('/run')
 def run_script():
-    global running_process
+    global run_start_id
+
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        last_event_id = None
 
     def generate():
-        global running_process
+        global run_start_id
 
         try:
-            if not SCRIPT_FILE.exists():
-                yield f"data: ERROR: {SCRIPT_FILE} not found\n\n"
-                yield "data: [ERROR]\n\n"
-                return
+            already_running = engine_running()
 
-            already_running = running_process is not None and running_process.poll() is None
+            # A browser reconnecting after a dropped connection resumes where it left off.
+            # Ids are log line numbers, so one from before a server restart also
+            # lands here; with no engine left to finish that run, just catch up.
+            if last_event_id is not None and last_event_id <= log_broadcaster.last_id():
+                yield from stream_log(last_event_id) if already_running else replay_log(last_event_id)
+                return
 
             if already_running:
                 yield "data: ✓ Monitoring is already running (reconnecting to logs...)\n\n"
-                if LOG_FILE.exists():
-                    with open(LOG_FILE, 'r') as f:
-                        lines = f.readlines()
-                        for line in lines[-50:]:
-                            yield f"data: {line.rstrip()}\n\n"
-                        f.seek(0, 2)
-                        while running_process and running_process.poll() is None:
-                            line = f.readline()
-                            if line:
-                                yield f"data: {line.rstrip()}\n\n"
-                            else:
-                                time.sleep(0.1)
-                yield "data: [DONE]\n\n"
+                yield from stream_log(max(log_broadcaster.last_id() - LOG_REPLAY_LINES, run_start_id))
                 return
 
-            yield "data: Starting rlog auto-uploader...\n\n"
-
-            log_file = open(LOG_FILE, 'w')
+            run_start_id = log_broadcaster.last_id()
+            publish_output(f"Starting rlog auto-uploader... ({time.strftime('%Y-%m-%d %H:%M:%S')})")
+            start_engine()
 
-            running_process = subprocess.Popen(
-                [sys.executable, str(SCRIPT_FILE)],
-                stdout=log_file,
-                stderr=subprocess.STDOUT,
-                universal_newlines=True,
-                bufsize=1
-            )
-
-            with open(LOG_FILE, 'r') as f:
-                while running_process and running_process.poll() is None:
-                    line = f.readline()
-                    if line:
-                        yield f"data: {line.rstrip()}\n\n"
-                    else:
-                        time.sleep(0.1)
-
-                for line in f.readlines():
-                    yield f"data: {line.rstrip()}\n\n"
-
-            log_file.close()
-            running_process.wait()
-            running_process = None
-
-            yield "data: [DONE]\n\n"
+            yield from stream_log(run_start_id)
 
         except Exception as e:
             yield f"data: ERROR: {str(e)}\n\n"
             yield "data: [ERROR]\n\n"
-            running_process = None
 
     return Response(generate(), mimetype='text/event-stream')
 
@@ -508,6 +940,6 @@ if __name__ == '__main__':
     print("Comma 3X Rlog Auto-Uploader - Web Interface")
     print("=" * 60)
     print(f"\n✓ Working directory: {Path.cwd()}")
-    print(f"✓ Script file: {SCRIPT_FILE.absolute()}")
+    print(f"✓ Config file: {CONFIG_FILE.absolute()}")
     print(f"\n🌐 Open: http://localhost:{port}\n")
     app.run(debug=False, host='0.0.0.0', port=port, threaded=True)
\ No newline at end of file
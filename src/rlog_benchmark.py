@@ -0,0 +1,733 @@
+#!/usr/bin/env python3
+
+import argparse
+import ast
+import base64
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+import paramiko
+
+import rlog_downloader
+
+SEGMENT_FILE_PATTERNS = ["rlog.zst", "rlog", "qlog.zst", "qlog"]
+PACKAGING_METHODS = ["deflate", "store", "auto"]
+SSH_CIPHERS = ["aes128-ctr", "aes256-ctr", "aes128-gcm@openssh.com", "aes256-gcm@openssh.com"]
+SSH_WINDOW_SIZES_MB = [2, 8, 16, 32]
+PIPELINE_DONGLE_ID = "benchmark0000000"
+
+
+def find_segment_files(paths):
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            for pattern in SEGMENT_FILE_PATTERNS:
+                files.extend(path.rglob(pattern))
+        elif path.is_file():
+            files.append(path)
+    return sorted(set(files))
+
+
+def bench_packaging(args):
+    files = find_segment_files(args.paths)
+    if not files:
+        print("No segment files found", file=sys.stderr)
+        return 1
+
+    input_bytes = sum(f.stat().st_size for f in files)
+    print(f"Packaging {len(files)} files, {input_bytes / (1024 * 1024):.2f} MB", file=sys.stderr)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for method in args.methods:
+            zip_path = Path(tmp) / f"{method}.zip"
+            start = time.monotonic()
+            with contextlib.redirect_stdout(io.StringIO()):
+                rlog_downloader.write_rlogs_zip(zip_path, files, method)
+            seconds = time.monotonic() - start
+            output_bytes = zip_path.stat().st_size
+            zip_path.unlink()
+            results.append({
+                "method": method,
+                "seconds": round(seconds, 3),
+                "input_bytes": input_bytes,
+                "output_bytes": output_bytes,
+                "bytes_saved": input_bytes - output_bytes,
+                "mb_per_s": round(input_bytes / (1024 * 1024) / max(seconds, 1e-6), 2),
+            })
+
+    return report(args, "packaging", results, ["method", "seconds", "mb_per_s", "output_bytes", "bytes_saved"],
+                  ["method"])
+
+
+def bench_ssh(args):
+    """Measure SFTP read throughput for each cipher and window size against a real host."""
+    if args.key:
+        rlog_downloader.COMMA_KEY_FILENAME = args.key
+
+    results = []
+    for cipher in args.ciphers:
+        for window_mb in args.windows:
+            connection = rlog_downloader.SSHConnection(
+                host=args.host, username=args.user, port=args.port,
+                ciphers=(cipher,), window_size=window_mb * 1024 * 1024
+            )
+            row = {"cipher": cipher, "window_mb": window_mb, "bytes": 0, "seconds": 0, "mb_per_s": 0}
+            try:
+                sftp = connection.connect()
+                if connection.transport.remote_cipher != cipher:
+                    row["error"] = f"negotiated {connection.transport.remote_cipher}"
+                else:
+                    row.update(read_remote_file(sftp, args.remote_file, args.max_bytes))
+            except Exception as e:
+                row["error"] = str(e)
+            finally:
+                connection.close()
+            print(f"{cipher} window={window_mb}MB: {row.get('error') or str(row['mb_per_s']) + ' MB/s'}",
+                  file=sys.stderr)
+            results.append(row)
+
+    return report(args, "ssh", results, ["cipher", "window_mb", "bytes", "seconds", "mb_per_s"],
+                  ["cipher", "window_mb"])
+
+
+def read_remote_file(sftp, remote_path, max_bytes):
+    size = min(sftp.stat(remote_path).st_size, max_bytes)
+    start = time.monotonic()
+    received = 0
+    with sftp.open(remote_path, 'rb') as f:
+        f.prefetch(size)
+        while received < size:
+            chunk = f.read(min(1024 * 1024, size - received))
+            if not chunk:
+                break
+            received += len(chunk)
+    seconds = time.monotonic() - start
+    return {
+        "bytes": received,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(received / (1024 * 1024) / max(seconds, 1e-6), 2),
+    }
+
+
+def make_realdata(root, routes, segments, segment_bytes, seed=0):
+    """Write a synthetic realdata tree of `routes` x `segments` rlog.zst files.
+
+    Contents are seeded random bytes behind a zstd magic number, so like real
+    rlogs they do not compress and identical arguments give identical trees.
+    """
+    rng = random.Random(seed)
+    for route in range(routes):
+        route_name = f"{route + 1:08x}--{rng.getrandbits(40):010x}"
+        for segment in range(segments):
+            segment_dir = root / f"{route_name}--{segment}"
+            segment_dir.mkdir(parents=True, exist_ok=True)
+            with open(segment_dir / "rlog.zst", "wb") as f:
+                f.write(rlog_downloader.COMPRESSED_MAGIC[0])
+                remaining = segment_bytes - len(rlog_downloader.COMPRESSED_MAGIC[0])
+                while remaining > 0:
+                    chunk = rng.randbytes(min(remaining, 1024 * 1024))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+
+class StandInSSHServer(paramiko.ServerInterface):
+    """Accepts any public key and runs exec requests in the local shell, as the device would."""
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_exec_request, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+def forward_stdin(channel, process):
+    try:
+        for chunk in iter(lambda: channel.recv(65536), b""):
+            process.stdin.write(chunk)
+        process.stdin.close()
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+
+
+def run_exec_request(channel, command):
+    try:
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        threading.Thread(target=forward_stdin, args=(channel, process), daemon=True).start()
+        for chunk in iter(lambda: process.stdout.read(65536), b""):
+            channel.sendall(chunk)
+        channel.sendall_stderr(process.stderr.read())
+        channel.send_exit_status(process.wait())
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+    finally:
+        channel.close()
+
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class LocalSFTPInterface(paramiko.SFTPServerInterface):
+    """Read-only SFTP view of the local filesystem."""
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            handle = LocalSFTPHandle(flags)
+            handle.readfile = open(path, "rb")
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle.filename = path
+        return handle
+
+
+def serve_sftp(listener):
+    host_key = paramiko.RSAKey.generate(2048)
+    while True:
+        sock, _ = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSFTPInterface)
+        try:
+            transport.start_server(server=StandInSSHServer())
+        except (OSError, EOFError, paramiko.SSHException):
+            # Presence probes connect and hang up before the handshake
+            transport.close()
+
+
+class FileBrowserStandIn(ThreadingHTTPServer):
+    """Answers FileBrowser's login, renew, resource and TUS requests; uploads are counted and discarded."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Injected disconnects cut requests mid-body
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileBrowserHandler)
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": int(time.time()) + 86400}).encode())
+        self.token = f"e30.{payload.rstrip(b'=').decode()}.benchmark"
+        self.lock = threading.Lock()
+        self.tus_offsets = {}
+
+
+class FileBrowserHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        """Read and discard the request body; returns its length."""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            total = 0
+            while True:
+                length = int(self.rfile.readline().split(b";")[0], 16)
+                self.discard(length)
+                self.rfile.readline()
+                if length == 0:
+                    return total
+                total += length
+        length = int(self.headers.get("Content-Length") or 0)
+        self.discard(length)
+        return length
+
+    def discard(self, length):
+        while length > 0:
+            chunk = self.rfile.read(min(length, 1024 * 1024))
+            if not chunk:
+                raise ConnectionError("client went away mid-body")
+            length -= len(chunk)
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        if self.headers.get("X-Auth") == self.server.token:
+            return True
+        self.reply(401)
+        return False
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/api/login":
+            self.read_body()
+            return self.reply(200, f'"{self.server.token}"'.encode())
+        if not self.authorized():
+            return
+        self.read_body()
+        if path == "/api/renew":
+            return self.reply(200, f'"{self.server.token}"'.encode())
+        if path.startswith("/api/resources/"):
+            return self.reply(200)
+        if path.startswith("/api/tus/"):
+            with self.server.lock:
+                self.server.tus_offsets[path] = 0
+            return self.reply(201)
+        self.reply(404)
+
+    def do_HEAD(self):
+        path = urlparse(self.path).path
+        if not self.authorized():
+            return
+        with self.server.lock:
+            offset = self.server.tus_offsets.get(path)
+        if offset is None:
+            return self.reply(404)
+        self.reply(200, headers={"Upload-Offset": str(offset)})
+
+    def do_PATCH(self):
+        path = urlparse(self.path).path
+        if not self.authorized():
+            return
+        offset = int(self.headers.get("Upload-Offset", -1))
+        with self.server.lock:
+            current = self.server.tus_offsets.get(path)
+        if current is None or current != offset:
+            self.read_body()
+            return self.reply(409)
+        received = self.read_body()
+        with self.server.lock:
+            self.server.tus_offsets[path] = offset + received
+        self.reply(204, headers={"Upload-Offset": str(offset + received)})
+
+
+class ShapedProxy:
+    """Local TCP proxy that degrades the link to `target_port`.
+
+    Each direction gets `latency` seconds of added delay and a `bandwidth`
+    cap in bytes/s (0 for none). The first `disconnects` connections are cut
+    once `disconnect_after` bytes have crossed them in either direction.
+    """
+
+    def __init__(self, target_port, latency=0, bandwidth=0, disconnect_after=0, disconnects=1):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.disconnect_after = disconnect_after
+        self.disconnects_left = disconnects if disconnect_after else 0
+        self.lock = threading.Lock()
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            client, _ = self.listener.accept()
+            try:
+                upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            except OSError:
+                client.close()
+                continue
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                cut_after = self.disconnect_after if self.disconnects_left > 0 else 0
+                self.disconnects_left -= bool(cut_after)
+            link = {"bytes": 0, "open": 2, "cut_after": cut_after, "lock": threading.Lock()}
+            for source, dest in ((client, upstream), (upstream, client)):
+                self.forward(source, dest, link, (client, upstream))
+
+    def forward(self, source, dest, link, sockets):
+        chunks = queue.Queue()
+        bucket = rlog_downloader.TokenBucket(self.bandwidth, max(self.bandwidth // 20, 65536))
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b""
+                chunks.put((time.monotonic() + self.latency, data))
+                if not data:
+                    return
+
+        def write():
+            while True:
+                due, data = chunks.get()
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                if not data:
+                    break
+                with link["lock"]:
+                    link["bytes"] += len(data)
+                    cut = link["cut_after"] and link["bytes"] > link["cut_after"]
+                if cut:
+                    close_sockets(sockets)
+                    return
+                bucket.consume(len(data))
+                try:
+                    dest.sendall(data)
+                except OSError:
+                    close_sockets(sockets)
+                    return
+            try:
+                dest.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            with link["lock"]:
+                link["open"] -= 1
+                if link["open"] == 0:
+                    close_sockets(sockets)
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+
+def close_sockets(sockets):
+    for sock in sockets:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+
+def serve_stand_ins(links, ready):
+    """Run the SFTP and FileBrowser stand-ins behind shaped proxies; reports (ssh_port, http_port)."""
+    sftp_listener = socket.create_server(("127.0.0.1", 0))
+    threading.Thread(target=serve_sftp, args=(sftp_listener,), daemon=True).start()
+    filebrowser = FileBrowserStandIn()
+    threading.Thread(target=filebrowser.serve_forever, daemon=True).start()
+
+    ssh_proxy = ShapedProxy(sftp_listener.getsockname()[1], **links["ssh"])
+    http_proxy = ShapedProxy(filebrowser.server_address[1], **links["http"])
+    ready.put((ssh_proxy.port, http_proxy.port))
+    threading.Event().wait()
+
+
+def parse_overrides(assignments):
+    overrides = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition("=")
+        if not name.isupper() or not hasattr(rlog_downloader, name):
+            raise SystemExit(f"--set: rlog_downloader has no setting {name!r}")
+        try:
+            overrides[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[name] = value
+    return overrides
+
+
+def configure_downloader(work_dir, realdata, ssh_port, http_port, key_file, overrides):
+    """Point rlog_downloader at the stand-ins, with all local state under `work_dir`."""
+    downloader = rlog_downloader
+    downloader.COMMA_IP = "127.0.0.1"
+    downloader.COMMA_SSH_PORT = ssh_port
+    downloader.COMMA_KEY_FILENAME = str(key_file)
+    downloader.REALDATA_PATH = str(realdata)
+    downloader.BASE_URL = f"http://127.0.0.1:{http_port}"
+    downloader.UPLOAD_PATH = "/benchmark/"
+    downloader.UPLOAD_PROGRESS_FILE = work_dir / "upload_progress.json"
+    downloader.STATE_DB_FILE = work_dir / "rlog_state.db"
+    downloader.METRICS_FILE = work_dir / "rlog_metrics.prom"
+    # The generated segments are all finished, however recently written
+    downloader.SEGMENT_SETTLE_SECONDS = 0
+    for name, value in overrides.items():
+        setattr(downloader, name, value)
+    downloader.download_bucket.set_rate(downloader.BANDWIDTH_LIMIT)
+
+
+def stage_row(stage, num_bytes, seconds):
+    return {
+        "stage": stage,
+        "bytes": num_bytes,
+        "seconds": round(seconds, 3),
+        "mb_per_s": round(num_bytes / (1024 * 1024) / max(seconds, 1e-6), 2),
+    }
+
+
+def run_pipeline(work_dir, stream, max_reconnects):
+    """Run one scan/download/package/upload pass (or scan/stream) and time each stage."""
+    downloader = rlog_downloader
+    temp_dir = work_dir / "temp"
+    output_dir = work_dir / "output"
+    for directory in (temp_dir, output_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+        directory.mkdir()
+    downloader.UPLOAD_PROGRESS_FILE.unlink(missing_ok=True)
+    downloader.filebrowser.reset()
+    connection = downloader.SSHConnection()
+    rows = []
+
+    try:
+        start = time.monotonic()
+        sftp = connection.connect()
+        rows.append(stage_row("connect", 0, time.monotonic() - start))
+
+        start = time.monotonic()
+        jobs = downloader.scan_new_rlogs(sftp, {})
+        total_bytes = sum(job.size for job in jobs)
+        rows.append(stage_row("scan", total_bytes, time.monotonic() - start))
+        if not jobs:
+            raise RuntimeError("no segments found on the stand-in device")
+
+        start = time.monotonic()
+        if not downloader.login_filebrowser():
+            raise RuntimeError("login to the FileBrowser stand-in failed")
+        rows.append(stage_row("login", 0, time.monotonic() - start))
+
+        if stream:
+            start = time.monotonic()
+            routes = downloader.stream_to_filebrowser(connection.get_sftp(), jobs, PIPELINE_DONGLE_ID)
+            rows.append(stage_row("stream", total_bytes, time.monotonic() - start))
+            if len(routes) != len(jobs):
+                rows[-1]["error"] = f"{len(jobs) - len(routes)} segments not uploaded"
+            return rows
+
+        start = time.monotonic()
+        rlogs, routes, remaining, reconnects = [], [], jobs, 0
+        while remaining:
+            got_rlogs, got_routes = downloader.download_segments(connection.get_sftp(), remaining, temp_dir)
+            rlogs += got_rlogs
+            routes += got_routes
+            remaining = [job for job in remaining if job.key not in set(got_routes)]
+            if remaining:
+                reconnects += 1
+                if reconnects > max_reconnects:
+                    raise RuntimeError(f"{len(remaining)} segments still missing after {max_reconnects} reconnects")
+        rows.append(stage_row("download", total_bytes, time.monotonic() - start))
+        rows[-1]["reconnects"] = reconnects
+
+        start = time.monotonic()
+        archives = downloader.create_zip_parts(rlogs, routes, PIPELINE_DONGLE_ID, output_dir)
+        rows.append(stage_row("package", total_bytes, time.monotonic() - start))
+
+        archive_bytes = sum(zip_path.stat().st_size for zip_path, _ in archives)
+        start = time.monotonic()
+        failed = downloader.upload_parts(archives)
+        rows.append(stage_row("upload", archive_bytes, time.monotonic() - start))
+        if failed:
+            rows[-1]["error"] = f"{len(failed)}/{len(archives)} parts failed"
+        return rows
+    finally:
+        connection.close()
+
+
+def bench_pipeline(args):
+    """Time every stage against local stand-ins for the device and FileBrowser."""
+    overrides = parse_overrides(args.set)
+    transports = args.transports or [overrides.get("DOWNLOAD_TRANSPORT", rlog_downloader.DOWNLOAD_TRANSPORT)]
+    mb = 1024 * 1024
+    links = {
+        "ssh": {
+            "latency": args.ssh_latency / 1000,
+            "bandwidth": int(args.ssh_bandwidth * mb),
+            "disconnect_after": int(args.ssh_disconnect_after * mb),
+            "disconnects": args.disconnects,
+        },
+        "http": {
+            "latency": args.http_latency / 1000,
+            "bandwidth": int(args.http_bandwidth * mb),
+            "disconnect_after": int(args.http_disconnect_after * mb),
+            "disconnects": args.disconnects,
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = Path(tmp)
+        if args.realdata:
+            realdata = Path(args.realdata).resolve()
+        else:
+            realdata = work_dir / "realdata"
+            print(f"Generating {args.routes}x{args.segments} segments of {args.segment_mb} MB...", file=sys.stderr)
+            make_realdata(realdata, args.routes, args.segments, int(args.segment_mb * mb), args.seed)
+        key_file = work_dir / "id_rsa"
+        paramiko.RSAKey.generate(2048).write_private_key_file(str(key_file))
+
+        ready = multiprocessing.Queue()
+        # A separate process keeps the stand-ins from competing for the GIL
+        server = multiprocessing.Process(target=serve_stand_ins, args=(links, ready), daemon=True)
+        server.start()
+        try:
+            ssh_port, http_port = ready.get(timeout=60)
+            configure_downloader(work_dir, realdata, ssh_port, http_port, key_file, overrides)
+            runs = {transport: [] for transport in transports}
+            for transport in transports:
+                rlog_downloader.DOWNLOAD_TRANSPORT = transport
+                for run in range(1, args.runs + 1):
+                    print(f"Run {run}/{args.runs} over {transport}...", file=sys.stderr)
+                    output = sys.stderr if args.verbose else io.StringIO()
+                    with contextlib.redirect_stdout(output):
+                        runs[transport].append(run_pipeline(work_dir, args.stream, args.max_reconnects))
+        finally:
+            server.terminate()
+            server.join()
+
+    results = []
+    for transport, transport_runs in runs.items():
+        for stage_rows in zip(*transport_runs):
+            row = {"transport": transport, **stage_rows[0]}
+            row["seconds"] = round(statistics.median(r["seconds"] for r in stage_rows), 3)
+            row["mb_per_s"] = round(statistics.median(r["mb_per_s"] for r in stage_rows), 2)
+            errors = [r["error"] for r in stage_rows if r.get("error")]
+            if errors:
+                row["error"] = "; ".join(errors)
+            results.append(row)
+
+    config = {
+        "realdata": str(args.realdata or f"{args.routes}x{args.segments}x{args.segment_mb}MB seed={args.seed}"),
+        "runs": args.runs,
+        "stream": args.stream,
+        "transports": transports,
+        "links": links,
+        "overrides": overrides,
+    }
+    return report(args, "pipeline", results, ["transport", "stage", "bytes", "seconds", "mb_per_s", "reconnects"],
+                  ["transport", "stage"], config)
+
+
+def compare_with_baseline(results, baseline_file, keys):
+    """Add the baseline's MB/s and the relative change to each row matching on `keys`."""
+    with open(baseline_file) as f:
+        baseline = {tuple(row.get(k) for k in keys): row for row in json.load(f)["results"]}
+    for row in results:
+        previous = baseline.get(tuple(row[k] for k in keys))
+        if previous is None or not previous.get("mb_per_s"):
+            row["baseline_mb_per_s"] = row["change_pct"] = None
+            continue
+        row["baseline_mb_per_s"] = previous["mb_per_s"]
+        row["change_pct"] = round((row["mb_per_s"] / previous["mb_per_s"] - 1) * 100, 1)
+
+
+def report(args, benchmark, results, columns, keys, config=None):
+    """Print results as a table or JSON; returns 1 if a row regressed past --max-regression."""
+    status = 0
+    if args.baseline:
+        compare_with_baseline(results, args.baseline, keys)
+        columns = columns + ["baseline_mb_per_s", "change_pct"]
+        if args.max_regression is not None and any(
+            row["change_pct"] is not None and row["change_pct"] < -args.max_regression for row in results
+        ):
+            print(f"Throughput regressed by more than {args.max_regression}%", file=sys.stderr)
+            status = 1
+
+    if args.json:
+        output = {"benchmark": benchmark, "results": results}
+        if config is not None:
+            output["config"] = config
+        json.dump(output, sys.stdout, indent=2)
+        print()
+        return status
+
+    print()
+    print("  ".join(f"{c:>14}" for c in columns))
+    for row in results:
+        cells = ("" if row.get(c) is None else row[c] for c in columns)
+        print("  ".join(f"{cell:>14}" for cell in cells) + (f"  {row['error']}" if row.get("error") else ""))
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the rlog uploader")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--baseline", help="JSON output of an earlier run to compare MB/s against")
+    parser.add_argument("--max-regression", type=float,
+                        help="exit with status 1 if any row is this many percent slower than the baseline")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    packaging = subparsers.add_parser("packaging", help="compare zip compression methods on real segments")
+    packaging.add_argument("paths", nargs="+", help="segment files or directories containing them")
+    packaging.add_argument("--methods", nargs="+", choices=PACKAGING_METHODS, default=PACKAGING_METHODS)
+    packaging.set_defaults(func=bench_packaging)
+
+    ssh = subparsers.add_parser("ssh", help="compare SSH ciphers and window sizes for bulk SFTP reads")
+    ssh.add_argument("host")
+    ssh.add_argument("remote_file", help="large file on the host to read, e.g. an rlog.zst")
+    ssh.add_argument("--user", default=rlog_downloader.COMMA_USER)
+    ssh.add_argument("--port", type=int, default=rlog_downloader.COMMA_SSH_PORT)
+    ssh.add_argument("--key", help="private key file (default: agent and ~/.ssh/id_*)")
+    ssh.add_argument("--ciphers", nargs="+", default=SSH_CIPHERS)
+    ssh.add_argument("--windows", nargs="+", type=int, default=SSH_WINDOW_SIZES_MB, help="window sizes in MB")
+    ssh.add_argument("--max-bytes", type=int, default=64 * 1024 * 1024)
+    ssh.set_defaults(func=bench_ssh)
+
+    pipeline = subparsers.add_parser(
+        "pipeline", help="time scan, download, package and upload against local device and FileBrowser stand-ins"
+    )
+    pipeline.add_argument("--realdata", help="serve this route tree instead of generating one")
+    pipeline.add_argument("--routes", type=int, default=4)
+    pipeline.add_argument("--segments", type=int, default=5, help="segments per route")
+    pipeline.add_argument("--segment-mb", type=float, default=8)
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.add_argument("--runs", type=int, default=3, help="report the median of this many runs")
+    pipeline.add_argument("--stream", action="store_true", help="measure STREAM_UPLOAD instead of staged upload")
+    pipeline.add_argument("--transports", nargs="+", choices=["sftp", "tar"],
+                          help="measure each DOWNLOAD_TRANSPORT in turn (default: the configured one)")
+    pipeline.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                          help="override an rlog_downloader setting, e.g. DOWNLOAD_WORKERS=8")
+    pipeline.add_argument("--ssh-latency", type=float, default=0, help="added one-way delay in ms")
+    pipeline.add_argument("--ssh-bandwidth", type=float, default=0, help="MB/s cap per direction, 0 for none")
+    pipeline.add_argument("--ssh-disconnect-after", type=float, default=0, help="cut SSH connections after this many MB")
+    pipeline.add_argument("--http-latency", type=float, default=0, help="added one-way delay in ms")
+    pipeline.add_argument("--http-bandwidth", type=float, default=0, help="MB/s cap per direction, 0 for none")
+    pipeline.add_argument("--http-disconnect-after", type=float, default=0,
+                          help="cut HTTP connections after this many MB")
+    pipeline.add_argument("--disconnects", type=int, default=1, help="how many connections per link to cut")
+    pipeline.add_argument("--max-reconnects", type=int, default=5)
+    pipeline.add_argument("--verbose", action="store_true", help="show the downloader's output on stderr")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
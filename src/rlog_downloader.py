@@ -1,21 +1,40 @@
 #!/usr/bin/env python3
 
 import os
+import asyncio
+import hashlib
+import base64
+import contextlib
 import zipfile
+import zlib
+import gzip
+import tarfile
 from pathlib import Path
 import paramiko
 import stat
 import requests
 from datetime import datetime
 import urllib3
-import subprocess
+import socket
 import time
 import json
+import queue
+import sqlite3
+import threading
+import shlex
+import signal
+import fnmatch
+import posixpath
+from collections import namedtuple
+from concurrent.futures import Executor, Future, as_completed
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 COMMA_IP = "172.20.10.3"
 COMMA_USER = "comma"
+COMMA_SSH_PORT = 22
+# Key used for the device; None tries the SSH agent and ~/.ssh/id_* keys.
+COMMA_KEY_FILENAME = None
 REALDATA_PATH = "/data/media/0/realdata"
 DONGLE_ID_PATH = "/data/params/d/DongleId"
 
@@ -25,57 +44,907 @@ if DATA_DIR.exists():
     LOCAL_TEMP_DIR = DATA_DIR / "comma_rlogs_temp"
     OUTPUT_DIR = DATA_DIR
     UPLOADED_LOGS_FILE = DATA_DIR / "uploaded_logs.json"
+    UPLOAD_PROGRESS_FILE = DATA_DIR / "upload_progress.json"
+    STATE_DB_FILE = DATA_DIR / "rlog_state.db"
+    METRICS_FILE = DATA_DIR / "rlog_metrics.prom"
+    CONFIG_FILE = DATA_DIR / "config.json"
 else:
     LOCAL_TEMP_DIR = Path("./comma_rlogs_temp")
     OUTPUT_DIR = Path(".")
     UPLOADED_LOGS_FILE = Path("uploaded_logs.json")
+    UPLOAD_PROGRESS_FILE = Path("upload_progress.json")
+    STATE_DB_FILE = Path("rlog_state.db")
+    METRICS_FILE = Path("rlog_metrics.prom")
+    # Next to the web server, which writes it
+    CONFIG_FILE = SCRIPT_DIR / "config.json"
 
 BASE_URL = "https://dl.relay.net:4443"
 UPLOAD_PATH = "/VW Passat NMS with torque steer/"
 USERNAME = "nnlc"
 PASSWORD = "nnlc"
 
+# config.json keys (as saved by the web interface) and the settings above
+# they replace. The engine re-reads the file when it changes, on SIGHUP, or
+# when the hosting web server asks, and applies only what changed.
+CONFIG_SETTINGS = {
+    "comma_ip": "COMMA_IP",
+    "comma_user": "COMMA_USER",
+    "base_url": "BASE_URL",
+    "upload_path": "UPLOAD_PATH",
+    "fb_username": "USERNAME",
+    "fb_password": "PASSWORD",
+}
+CONFIG_POLL_INTERVAL = 2
+
+# Devices watched concurrently. Each entry is a dict that may set "name",
+# "host", "port", "username" and "key_filename" for SSH, and "base_url",
+# "upload_path", "filebrowser_username" and "filebrowser_password" for its
+# FileBrowser account; missing keys fall back to the settings above. An empty
+# list watches the single device at COMMA_IP.
+DEVICES = []
+
+# Presence detection: TCP probes of the device's sshd, spaced from
+# PRESENCE_MIN_INTERVAL up to PRESENCE_MAX_INTERVAL while it stays away. A
+# change in the neighbor table (or DHCP leases file, if set) for the device
+# triggers an immediate probe.
+PRESENCE_MIN_INTERVAL = 0.5
+PRESENCE_MAX_INTERVAL = 5
+PRESENCE_PROBE_TIMEOUT = 2
+PRESENCE_LEAVE_FAILURES = 3
+NEIGHBOR_TABLE_FILE = Path("/proc/net/arp")
+DHCP_LEASES_FILE = None
+
+# SSH transport tuning. paramiko's defaults are a 2 MB window and no
+# keepalive; a larger window keeps more SFTP reads in flight on a
+# high-latency link. SSH_CIPHERS lists preferred ciphers in order (None keeps
+# paramiko's order); see `rlog_benchmark.py ssh` to measure them.
+SSH_WINDOW_SIZE = 16 * 1024 * 1024
+SSH_MAX_PACKET_SIZE = 32768
+SSH_CIPHERS = ("aes128-gcm@openssh.com", "aes128-ctr", "aes256-gcm@openssh.com", "aes256-ctr")
+SSH_KEEPALIVE_INTERVAL = 15
+SSH_CONNECT_TIMEOUT = 10
+
+# Number of SFTP channels opened on the SSH transport; each keeps one segment
+# transfer in flight.
+DOWNLOAD_WORKERS = 4
+# Segments are fetched in chunks of this size into a ".part" file whose length
+# is the resume offset after a dropped connection.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# How segments leave the device: "sftp" opens and reads each file over the
+# channel pool above; "tar" runs one `tar` on the device and reads every
+# selected file from its output on a single exec channel, saving the
+# per-file round trips. See `rlog_benchmark.py pipeline --transports` to
+# pick one for a link. A tar stream cannot seek, so an interrupted file
+# starts over instead of resuming from its ".part".
+DOWNLOAD_TRANSPORT = "sftp"
+# Compress the tar stream on the device: None, "gzip" or "zstd" (needs the
+# zstandard package here; without it the stream is sent uncompressed).
+# rlog.zst and qlog.zst are already compressed, so this only pays off for
+# uncompressed logs on a slow link.
+TAR_COMPRESSION = None
+# Order in which new segments are fetched: "newest", "oldest", "smallest" or
+# "route" (whole routes, newest route first). See SCHEDULE_POLICIES.
+SCHEDULE_POLICY = "newest"
+# Files synced from each segment directory. Per type: the first file whose
+# name matches "pattern" is fetched unless it is larger than "max_bytes"
+# (None: no cap). Lower "priority" types are fetched first; within a
+# priority, SCHEDULE_POLICY decides. Each file is tracked separately in the
+# state database. To pull small qlogs quickly and backfill rlogs after them:
+#   FILE_TYPES = [
+#       {"name": "qlog", "pattern": "qlog*", "max_bytes": 50 * 1024 * 1024, "priority": 0},
+#       {"name": "rlog", "pattern": "rlog*", "max_bytes": None, "priority": 1},
+#   ]
+FILE_TYPES = [
+    {"name": "rlog", "pattern": "rlog.zst", "max_bytes": None, "priority": 0},
+]
+# openpilot keeps writing the newest segment of the newest route while the
+# car is on. Its files are deferred until they have not changed for this many
+# seconds, judged by the device clock against their mtime or by repeated
+# scans, and a connected device is rescanned at this interval to pick them up.
+# 0 syncs them as soon as they are seen.
+SEGMENT_SETTLE_SECONDS = 30
+# Cap on download bandwidth in bytes/s shared by all channels; 0 is unlimited.
+BANDWIDTH_LIMIT = 0
+# Expected seconds the device stays in range; when set, only the segments
+# that fit at the measured throughput are scheduled. 0 schedules everything.
+# The budget is skipped until a first sync has measured the throughput.
+TIME_BUDGET_SECONDS = 0
+# Compare a SHA-256 computed on the device with the one computed while
+# downloading; a mismatching segment is deleted and fetched again.
+VERIFY_CHECKSUMS = True
+
+# Pipelined mode: stream segments from SFTP through the zip writer straight
+# into the HTTP upload instead of staging them in LOCAL_TEMP_DIR first.
+STREAM_UPLOAD = False
+# Chunks of DOWNLOAD_CHUNK_SIZE buffered between the zip writer and the upload.
+STREAM_BUFFER_CHUNKS = 8
+
+# "auto" stores already-compressed inputs (rlog.zst) as-is and deflates the
+# rest when a quick probe shows it is worth it; "store" and "deflate" force a
+# single method for every file.
+ZIP_COMPRESSION = "auto"
+COMPRESSION_PROBE_BYTES = 256 * 1024
+# Deflate only if the probe shrinks to less than this fraction of its size.
+COMPRESSION_MIN_RATIO = 0.9
+# Archives are sent to FileBrowser's TUS endpoint in chunks of this size so a
+# failed upload continues from the last acknowledged offset. 0 sends the whole
+# file in one POST.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5
+UPLOAD_RETRY_DELAY = 5
+# A batch is split into zip parts of at most this many input bytes (a larger
+# single segment gets a part of its own); 0 keeps one archive per batch.
+ARCHIVE_PART_MAX_BYTES = 512 * 1024 * 1024
+# Parts uploaded at once over the pooled HTTP session, and how many rounds
+# failed parts get before they are left for a later attempt.
+UPLOAD_WORKERS = 3
+UPLOAD_PART_ATTEMPTS = 2
+# Archives that did not reach FileBrowser wait in the outbox and are retried in
+# the background, with or without a car in range, after OUTBOX_RETRY_DELAY
+# doubling up to OUTBOX_RETRY_MAX_DELAY. Their segments are not downloaded
+# again. Past OUTBOX_MAX_BYTES (None: no cap) the oldest archives are deleted
+# and their segments go back to be fetched on a later visit.
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_RETRY_MAX_DELAY = 3600
+OUTBOX_POLL_INTERVAL = 15
+OUTBOX_MAX_BYTES = 20 * 1024 * 1024 * 1024
+# Uploads in flight at once across all devices. Parts and streams wait for a
+# slot, so several cars in range share the uplink instead of oversubscribing it.
+UPLINK_CONCURRENCY = 3
+# Renew the FileBrowser token this many seconds before its JWT expiry.
+TOKEN_RENEW_MARGIN = 60
+
+# A standalone downloader rewrites METRICS_FILE this often, for a
+# Prometheus textfile collector; the web server serves /metrics from memory.
+METRICS_WRITE_INTERVAL = 15
+# A hosting program gets at most one bytes_progress event per file this often.
+PROGRESS_EVENT_INTERVAL = 0.5
+# Events buffered for an Engine's consumer; progress is dropped when it is full.
+ENGINE_EVENT_QUEUE_SIZE = 10000
+STAGE_SECONDS_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+SEGMENT_BYTES_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(9))  # 1 MB .. 256 MB
+PRESENCE_DETECT_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30)
+
+COMPRESSED_MAGIC = (
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"\x1f\x8b",  # gzip
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+)
+
+
+# name: (type, help, histogram buckets)
+METRIC_DEFINITIONS = {
+    "rlog_stage_seconds": ("histogram", "Duration of each pipeline stage run.", STAGE_SECONDS_BUCKETS),
+    "rlog_stage_bytes_total": ("counter", "Bytes handled by each pipeline stage.", None),
+    "rlog_segment_bytes": ("histogram", "Size of downloaded segment files.", SEGMENT_BYTES_BUCKETS),
+    "rlog_segments_total": ("counter", "Segment state transitions by new status.", None),
+    "rlog_retries_total": ("counter", "Retried operations by kind.", None),
+    "rlog_queue_depth": ("gauge", "Items waiting in each pipeline queue.", None),
+    "rlog_device_online": ("gauge", "1 while the device is reachable.", None),
+    "rlog_device_online_seconds_total": ("counter", "Time the device has been reachable.", None),
+    "rlog_presence_detect_seconds": ("histogram", "Delay from the device's sshd coming up to its detection.",
+                                     PRESENCE_DETECT_BUCKETS),
+    "rlog_device_segments": ("gauge", "Segments of the device's dongle by status.", None),
+    "rlog_cycles_total": ("counter", "Completed download/upload cycles by result.", None),
+}
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format."""
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            # Cumulative bucket counts, then sum and count
+            histogram = self.values.setdefault(key, [0] * len(buckets) + [0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def render(self):
+        with self.lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(labels)} {format_metric_value(value)}")
+                    continue
+                for bound, count in zip(buckets + (float("inf"),), value[:-2] + [value[-1]]):
+                    le = format_metric_value(float(bound))
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_metric_value(value[-2])}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        path = Path(path or METRICS_FILE)
+        tmp_file = path.with_name(path.name + ".tmp")
+        tmp_file.write_text(self.render())
+        os.replace(tmp_file, path)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+
+def format_metric_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+
+# Callables receiving every event dict. Types: log, segment_started,
+# bytes_progress, stage_done and error.
+event_handlers = []
+
+
+def emit(event_type, **fields):
+    if not event_handlers:
+        return
+    event = {"type": event_type, "time": time.time(), **fields}
+    for handler in list(event_handlers):
+        handler(event)
+
 
-def load_uploaded_logs():
-    if UPLOADED_LOGS_FILE.exists():
-        with open(UPLOADED_LOGS_FILE, 'r') as f:
-            return set(json.load(f))
-    return set()
+def log(message=""):
+    """Print `message`, or hand it to the event handlers when a program hosts the engine."""
+    if event_handlers:
+        emit("log", message=message)
+    else:
+        print(message)
 
 
-def save_uploaded_logs(uploaded_logs):
-    with open(UPLOADED_LOGS_FILE, 'w') as f:
-        json.dump(list(uploaded_logs), f, indent=2)
+def log_error(message, **fields):
+    log(message)
+    emit("error", message=message.strip(), **fields)
 
 
-def ping_comma():
+def finish_stage(stage, seconds, **fields):
+    metrics.observe("rlog_stage_seconds", seconds, stage=stage)
+    emit("stage_done", stage=stage, seconds=seconds, **fields)
+
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    start = time.monotonic()
     try:
-        result = subprocess.run(
-            ['ping', '-c', '1', '-W', '2', COMMA_IP],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        return result.returncode == 0
-    except:
+        yield
+    finally:
+        finish_stage(stage, time.monotonic() - start)
+
+
+class ProgressEmitter:
+    """Emits bytes_progress for one file at most every PROGRESS_EVENT_INTERVAL."""
+
+    def __init__(self, stage, name, total, done=0):
+        self.stage = stage
+        self.name = name
+        self.total = total
+        self.start_done = done
+        self.start = self.last = time.monotonic()
+
+    def update(self, done, force=False):
+        if not event_handlers:
+            return
+        now = time.monotonic()
+        if not force and now - self.last < PROGRESS_EVENT_INTERVAL:
+            return
+        self.last = now
+        elapsed = now - self.start
+        emit("bytes_progress", stage=self.stage, file=self.name, done=done, total=self.total,
+             rate=(done - self.start_done) / elapsed if elapsed > 0 else None)
+
+
+# Set while the engine shuts down; workers check it between chunks.
+stop_requested = threading.Event()
+
+
+class EngineStopped(BaseException):
+    """Unwinds a worker thread when the engine stops.
+
+    Like asyncio.CancelledError it is not an Exception, so the retry loops
+    that catch Exception let it through.
+    """
+
+
+def check_stopped():
+    if stop_requested.is_set():
+        raise EngineStopped()
+
+
+SEGMENT_STATUSES = ("seen", "downloaded", "packaged", "uploaded")
+
+
+class SegmentStore:
+    """Per-segment state in SQLite, keyed by dongle ID and segment name.
+
+    Replaces the flat uploaded_logs.json list: status changes are single-row
+    writes, membership is a primary-key lookup and each segment keeps its
+    size, mtime and the time it reached every status.
+    """
+
+    SCHEMA_VERSION = 5
+    # Route directory of a "<route>/<file name>" segment key
+    ROUTE = "substr(segment, 1, instr(segment, '/') - 1)"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Outbox archives a worker in this process is uploading
+        self.in_flight = set()
+        self.db = sqlite3.connect(str(path), check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            with self.db:
+                self.db.execute("""
+                    CREATE TABLE IF NOT EXISTS segments (
+                        dongle_id TEXT NOT NULL,
+                        segment TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        size INTEGER,
+                        mtime REAL,
+                        sha256 TEXT,
+                        archive TEXT,
+                        seen_at REAL,
+                        downloaded_at REAL,
+                        packaged_at REAL,
+                        uploaded_at REAL,
+                        PRIMARY KEY (dongle_id, segment)
+                    ) WITHOUT ROWID
+                """)
+                self.db.execute("CREATE INDEX IF NOT EXISTS segments_status ON segments (status, dongle_id)")
+                self.db.execute("PRAGMA user_version = 1")
+        if version < 2:
+            # One row per archive that reached FileBrowser, for throughput history
+            with self.db:
+                self.db.execute("""
+                    CREATE TABLE IF NOT EXISTS uploads (
+                        id INTEGER PRIMARY KEY,
+                        dongle_id TEXT NOT NULL,
+                        archive TEXT,
+                        segments INTEGER NOT NULL,
+                        bytes INTEGER NOT NULL,
+                        seconds REAL NOT NULL,
+                        uploaded_at REAL NOT NULL
+                    )
+                """)
+                self.db.execute("PRAGMA user_version = 2")
+        if version < 3:
+            # Archives awaiting upload; next_attempt_at is NULL while one is in flight
+            with self.db:
+                self.db.execute("""
+                    CREATE TABLE IF NOT EXISTS outbox (
+                        archive TEXT PRIMARY KEY,
+                        dongle_id TEXT NOT NULL,
+                        device TEXT,
+                        routes TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        next_attempt_at REAL,
+                        last_error TEXT,
+                        created_at REAL NOT NULL
+                    )
+                """)
+                self.db.execute("PRAGMA user_version = 3")
+        if version < 4:
+            # Rows were keyed by route directory and only ever held rlog.zst;
+            # keys are now "<route>/<file name>" with the file type alongside.
+            with self.db:
+                self.db.execute("ALTER TABLE segments ADD COLUMN file_type TEXT")
+                self.db.execute("UPDATE segments SET segment = segment || '/rlog.zst', file_type = 'rlog'")
+                for archive, routes in self.db.execute("SELECT archive, routes FROM outbox").fetchall():
+                    self.db.execute(
+                        "UPDATE outbox SET routes = ? WHERE archive = ?",
+                        (json.dumps([f"{route}/rlog.zst" for route in json.loads(routes)]), archive)
+                    )
+                self.db.execute("PRAGMA user_version = 4")
+        if version < 5:
+            # Named estimates carried across restarts, e.g. download throughput
+            with self.db:
+                self.db.execute("""
+                    CREATE TABLE IF NOT EXISTS estimates (
+                        name TEXT PRIMARY KEY,
+                        value REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+                self.db.execute("PRAGMA user_version = 5")
+
+    def close(self):
+        self.db.close()
+
+    def migrate_legacy_json(self, json_file, dongle_id):
+        """Import a pre-SQLite uploaded_logs.json under `dongle_id`, once."""
+        if not json_file.exists():
+            return 0
+        try:
+            with open(json_file, 'r') as f:
+                segments = json.load(f)
+        except Exception as e:
+            log(f"Warning: Failed to read {json_file}: {e}")
+            return 0
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("""
+                INSERT OR IGNORE INTO segments (dongle_id, segment, file_type, status, uploaded_at)
+                VALUES (?, ?, 'rlog', 'uploaded', ?)
+            """, [(dongle_id, f"{segment}/rlog.zst", now) for segment in segments])
+        json_file.replace(json_file.with_name(json_file.name + ".migrated"))
+        log(f"Migrated {len(segments)} routes from {json_file.name}")
+        return len(segments)
+
+    def settled_segments(self, dongle_id):
+        """Return {segment: size} for the dongle's segments that need no download (size may be None).
+
+        These are the uploaded segments and those packaged into an archive
+        still waiting in the outbox.
+        """
+        with self.lock:
+            rows = self.db.execute("""
+                SELECT segment, size FROM segments
+                WHERE dongle_id = ? AND (status = 'uploaded'
+                    OR (status = 'packaged' AND archive IN (SELECT archive FROM outbox)))
+            """, (dongle_id,)).fetchall()
+        return dict(rows)
+
+    def mark_seen(self, dongle_id, jobs):
+        """Record the remote size and mtime of each SegmentJob.
+
+        An uploaded segment whose remote size has since changed goes back to
+        "seen" so it is picked up again.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            for job in jobs:
+                self.db.execute("""
+                    INSERT INTO segments (dongle_id, segment, file_type, status, size, mtime, seen_at)
+                    VALUES (?, ?, ?, 'seen', ?, ?, ?)
+                    ON CONFLICT (dongle_id, segment) DO UPDATE SET
+                        status = CASE WHEN status = 'uploaded' AND size IS NOT NULL AND size != excluded.size
+                                      THEN 'seen' ELSE status END,
+                        file_type = excluded.file_type,
+                        size = excluded.size,
+                        mtime = excluded.mtime,
+                        seen_at = excluded.seen_at
+                """, (dongle_id, job.key, job.file_type, job.size, job.mtime, now))
+
+    def mark(self, dongle_id, segments, status, archive=None, checksums=None):
+        if status not in SEGMENT_STATUSES:
+            raise ValueError(f"unknown segment status {status!r}")
+        checksums = checksums or {}
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(f"""
+                INSERT INTO segments (dongle_id, segment, status, archive, sha256, {status}_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (dongle_id, segment) DO UPDATE SET
+                    status = excluded.status,
+                    archive = COALESCE(excluded.archive, archive),
+                    sha256 = COALESCE(excluded.sha256, sha256),
+                    {status}_at = excluded.{status}_at
+            """, [(dongle_id, segment, status, archive, checksums.get(segment), now) for segment in segments])
+        metrics.inc("rlog_segments_total", len(segments), status=status)
+
+    def record_upload(self, dongle_id, archive, segments, size, seconds):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO uploads (dongle_id, archive, segments, bytes, seconds, uploaded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (dongle_id, archive, segments, size, seconds, time.time())
+            )
+
+    def uploads_since(self, upload_id):
+        """Return the uploads rows with an id above `upload_id`, oldest first."""
+        with self.lock:
+            cursor = self.db.execute(
+                "SELECT id, dongle_id, archive, segments, bytes, seconds, uploaded_at FROM uploads WHERE id > ? ORDER BY id",
+                (upload_id,)
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def latest_upload_id(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM uploads").fetchone()[0]
+
+    def upload_totals(self):
+        """Return {dongle_id: (routes, bytes, last uploaded_at)} over uploaded files.
+
+        A route counts once however many of its file types were uploaded.
+        """
+        with self.lock:
+            rows = self.db.execute(f"""
+                SELECT dongle_id, COUNT(DISTINCT {self.ROUTE}), COALESCE(SUM(size), 0), MAX(uploaded_at)
+                FROM segments WHERE status = 'uploaded' GROUP BY dongle_id
+            """).fetchall()
+        return {dongle_id: tuple(totals) for dongle_id, *totals in rows}
+
+    def get_estimate(self, name):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM estimates WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_estimate(self, name, value):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO estimates (name, value, updated_at) VALUES (?, ?, ?)",
+                (name, value, time.time())
+            )
+
+    def outbox_add(self, dongle_id, device, archive, routes):
+        """Queue an archive as in flight; outbox_retry_later schedules its next attempt."""
+        with self.lock, self.db:
+            self.db.execute("""
+                INSERT OR REPLACE INTO outbox (archive, dongle_id, device, routes, size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (str(archive), dongle_id, device, json.dumps(routes), archive.stat().st_size, time.time()))
+            self.in_flight.add(str(archive))
+
+    def outbox_claim_next(self, now=None):
+        """Mark the oldest due archive as in flight and return it, or None."""
+        now = time.time() if now is None else now
+        with self.lock, self.db:
+            cursor = self.db.execute("""
+                SELECT archive, dongle_id, device, routes, size, attempts FROM outbox
+                WHERE next_attempt_at <= ? ORDER BY created_at LIMIT 1
+            """, (now,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE outbox SET next_attempt_at = NULL WHERE archive = ?", (row[0],))
+            self.in_flight.add(row[0])
+        entry = dict(zip([column[0] for column in cursor.description], row))
+        entry["routes"] = json.loads(entry["routes"])
+        return entry
+
+    def outbox_retry_later(self, archive, delay, error=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE archive = ?",
+                (time.time() + delay, error, str(archive))
+            )
+            self.in_flight.discard(str(archive))
+
+    def outbox_release(self, archive):
+        """Make an in-flight archive due now without counting an attempt."""
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET next_attempt_at = ? WHERE archive = ? AND next_attempt_at IS NULL",
+                (time.time(), str(archive))
+            )
+            self.in_flight.discard(str(archive))
+
+    def outbox_release_all(self):
+        """Make archives left in flight by an earlier run due now, except those a live worker still owns."""
+        now = time.time()
+        with self.lock, self.db:
+            orphans = [
+                (now, archive) for (archive,) in self.db.execute("SELECT archive FROM outbox WHERE next_attempt_at IS NULL")
+                if archive not in self.in_flight
+            ]
+            self.db.executemany("UPDATE outbox SET next_attempt_at = ? WHERE archive = ?", orphans)
+
+    def outbox_remove(self, archive):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM outbox WHERE archive = ?", (str(archive),))
+            self.in_flight.discard(str(archive))
+
+    def outbox_entries(self):
+        """Return every outbox entry, oldest first."""
+        with self.lock:
+            cursor = self.db.execute("""
+                SELECT archive, dongle_id, device, routes, size, attempts, next_attempt_at, last_error
+                FROM outbox ORDER BY created_at
+            """)
+            columns = [column[0] for column in cursor.description]
+            entries = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for entry in entries:
+            entry["routes"] = json.loads(entry["routes"])
+        return entries
+
+    def count(self, status="uploaded"):
+        """Number of routes with a file in `status`; a route counts once across its file types."""
+        with self.lock:
+            return self.db.execute(
+                f"SELECT COUNT(DISTINCT {self.ROUTE}) FROM segments WHERE status = ?", (status,)
+            ).fetchone()[0]
+
+    def file_type_counts(self, dongle_id, status="uploaded"):
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT file_type, COUNT(*) FROM segments WHERE dongle_id = ? AND status = ? GROUP BY file_type",
+                (dongle_id, status)
+            ).fetchall())
+
+    def status_counts(self, dongle_id):
+        with self.lock:
+            return dict(self.db.execute(
+                "SELECT status, COUNT(*) FROM segments WHERE dongle_id = ? GROUP BY status", (dongle_id,)
+            ).fetchall())
+
+    def clear(self):
+        """Forget all history, deleting the archives waiting in the outbox.
+
+        Those archives hold segments that would otherwise be downloaded and
+        uploaded a second time. Archives a worker is uploading are left to
+        finish.
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM segments")
+            self.db.execute("DELETE FROM uploads")
+            waiting = [archive for (archive,) in self.db.execute("SELECT archive FROM outbox")
+                       if archive not in self.in_flight]
+            self.db.executemany("DELETE FROM outbox WHERE archive = ?", [(archive,) for archive in waiting])
+        for archive in waiting:
+            Path(archive).unlink(missing_ok=True)
+
+
+config_mtime = None
+config_lock = threading.Lock()
+
+
+def reload_config(force=False):
+    """Copy config.json settings that differ from the current ones; returns the changed names.
+
+    Unless `force` is set, the file is only read when its mtime has changed.
+    """
+    global config_mtime
+    with config_lock:
+        try:
+            mtime = CONFIG_FILE.stat().st_mtime_ns
+        except OSError:
+            return set()
+        if mtime == config_mtime and not force:
+            return set()
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                config = json.load(f)
+        except Exception as e:
+            log(f"Warning: Failed to load config: {e}")
+            return set()
+        config_mtime = mtime
+        changed = set()
+        for key, name in CONFIG_SETTINGS.items():
+            if key in config and config[key] != globals()[name]:
+                globals()[name] = config[key]
+                changed.add(name)
+        return changed
+
+
+def refresh_config(devices, force=False):
+    """Reload config.json and apply the changed settings to running devices.
+
+    A new device IP drops idle connections to the old one; a sync already in
+    progress finishes on its connection. New FileBrowser settings discard
+    cached tokens so the next request logs in again.
+    """
+    changed = reload_config(force)
+    if not changed:
+        return changed
+    log(f"Config reloaded: {', '.join(sorted(changed))} changed")
+    if changed & {"COMMA_IP", "COMMA_USER"}:
+        for device in devices:
+            if device.state != "syncing":
+                device.connection.close()
+    if changed & {"BASE_URL", "USERNAME", "PASSWORD"}:
+        filebrowser.reset()
+        for device in devices:
+            device.filebrowser.reset()
+    return changed
+
+
+async def probe_ssh(host=None, port=None, timeout=None):
+    """Return True once the device's sshd accepts a connection and sends its banner."""
+    host = host or COMMA_IP
+    port = port or COMMA_SSH_PORT
+    timeout = PRESENCE_PROBE_TIMEOUT if timeout is None else timeout
+
+    async def read_banner():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            return await reader.readexactly(4) == b"SSH-"
+        finally:
+            writer.close()
+
+    try:
+        return await asyncio.wait_for(read_banner(), timeout)
+    except (OSError, EOFError, asyncio.TimeoutError):
         return False
 
 
-def wait_for_comma():
-    print(f"Waiting for Comma 3X at {COMMA_IP}...")
+def neighbor_signature(host=None):
+    """Snapshot of the local host's view of the device: its ARP entry and the DHCP leases mtime."""
+    host = host or COMMA_IP
+    signature = []
+    try:
+        with open(NEIGHBOR_TABLE_FILE, 'r') as f:
+            signature.append(next((line.split() for line in f if line.split()[:1] == [host]), None))
+    except OSError:
+        pass
+    if DHCP_LEASES_FILE:
+        try:
+            signature.append(Path(DHCP_LEASES_FILE).stat().st_mtime)
+        except OSError:
+            pass
+    return signature
+
+
+async def wait_for_device(device):
+    """Probe until the device's sshd answers; returns the detection latency."""
+    log(f"[{device.name}] Waiting for Comma 3X at {device.host}...")
+
+    interval = PRESENCE_MIN_INTERVAL
+    last_failure = time.monotonic()
+    signature = neighbor_signature(device.host)
+    while not await probe_ssh(device.host, device.port):
+        last_failure = time.monotonic()
+        next_probe = last_failure + interval
+        interval = min(interval * 1.5, PRESENCE_MAX_INTERVAL)
+        while time.monotonic() < next_probe:
+            await asyncio.sleep(min(0.25, PRESENCE_MIN_INTERVAL))
+            current = neighbor_signature(device.host)
+            if current != signature:
+                signature = current
+                interval = PRESENCE_MIN_INTERVAL
+                break
+    latency = time.monotonic() - last_failure
+    log(f"[{device.name}] ✓ Comma 3X is online! (sshd detected within {latency:.2f}s)")
+    return latency
+
 
-    while not ping_comma():
-        print(".", end="", flush=True)
-        time.sleep(5)
-    print("\n✓ Comma 3X is online!")
-    return True
+async def wait_for_device_to_leave(device):
+    failures = 0
+    while failures < PRESENCE_LEAVE_FAILURES:
+        await asyncio.sleep(PRESENCE_MAX_INTERVAL)
+        failures = 0 if await probe_ssh(device.host, device.port) else failures + 1
+    log(f"[{device.name}] ✗ Comma 3X disconnected")
+
+
+def open_sftp_channel(transport):
+    return paramiko.SFTPClient.from_transport(
+        transport, window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE
+    )
+
+
+class SSHConnection:
+    """A long-lived, tuned SSH transport to the device.
+
+    The transport is kept alive with keepalives through the zip and upload
+    phases instead of being rebuilt every cycle. The key that authenticated
+    is remembered, so a reconnect after a drop costs one auth attempt.
+    """
+
+    def __init__(self, host=None, username=None, port=None, ciphers=None, window_size=None, key_filename=None):
+        self.host = host
+        self.username = username
+        self.port = port
+        self.key_filename = key_filename
+        self.ciphers = ciphers
+        self.window_size = window_size
+        self.transport = None
+        self.sftp = None
+        self.auth_key = None
+
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
 
+    def candidate_keys(self):
+        keys = [self.auth_key] if self.auth_key else []
+        try:
+            keys.extend(paramiko.Agent().get_keys())
+        except Exception:
+            pass
+        key_filename = self.key_filename or COMMA_KEY_FILENAME
+        if key_filename:
+            paths = [Path(key_filename)]
+        else:
+            paths = [Path.home() / ".ssh" / name for name in ("id_ed25519", "id_ecdsa", "id_rsa")]
+        for path in paths:
+            if path.exists():
+                try:
+                    keys.append(paramiko.PKey.from_path(str(path)))
+                except Exception as e:
+                    log(f"Warning: could not load SSH key {path}: {e}")
+        return keys
+
+    def connect(self):
+        self.close()
+        host = self.host or COMMA_IP
+        username = self.username or COMMA_USER
+        sock = socket.create_connection((host, self.port or COMMA_SSH_PORT), timeout=SSH_CONNECT_TIMEOUT)
+        # SFTP requests are small writes; without this, Nagle and delayed ACKs
+        # stall every read that misses the prefetch by ~40 ms.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        transport = paramiko.Transport(
+            sock,
+            default_window_size=self.window_size or SSH_WINDOW_SIZE,
+            default_max_packet_size=SSH_MAX_PACKET_SIZE
+        )
+        ciphers = self.ciphers or SSH_CIPHERS
+        if ciphers:
+            options = transport.get_security_options()
+            preferred = tuple(c for c in ciphers if c in options.ciphers)
+            if preferred:
+                options.ciphers = preferred
 
-def connect_sftp():
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(COMMA_IP, username=COMMA_USER, look_for_keys=True, timeout=10)
-    sftp = ssh.open_sftp()
-    return ssh, sftp
+        try:
+            transport.start_client(timeout=SSH_CONNECT_TIMEOUT)
+            tried = set()
+            for key in self.candidate_keys():
+                fingerprint = key.get_fingerprint()
+                if fingerprint in tried:
+                    continue
+                tried.add(fingerprint)
+                try:
+                    transport.auth_publickey(username, key)
+                except paramiko.AuthenticationException:
+                    continue
+                if transport.is_authenticated():
+                    self.auth_key = key
+                    break
+            if not transport.is_authenticated():
+                raise paramiko.AuthenticationException(f"no SSH key accepted for {username}@{host}")
+        except Exception:
+            transport.close()
+            raise
+
+        transport.set_keepalive(SSH_KEEPALIVE_INTERVAL)
+        self.transport = transport
+        self.sftp = open_sftp_channel(transport)
+        return self.sftp
+
+    def get_sftp(self):
+        """Return the SFTP session, reconnecting if the transport has dropped."""
+        if self.is_active() and self.sftp is not None:
+            return self.sftp
+        return self.connect()
+
+    def close(self):
+        for resource in (self.sftp, self.transport):
+            if resource is not None:
+                try:
+                    resource.close()
+                except Exception:
+                    pass
+        self.sftp = None
+        self.transport = None
 
 
 def get_dongle_id(sftp):
@@ -83,226 +952,1899 @@ def get_dongle_id(sftp):
         with sftp.file(DONGLE_ID_PATH, 'r') as f:
             return f.read().decode().strip()
     except Exception as e:
-        print(f"Error reading dongle ID: {e}")
+        log(f"Error reading dongle ID: {e}")
         return "unknown"
 
 
-def download_new_rlogs(sftp, temp_dir, uploaded_logs):
-    temp_dir.mkdir(exist_ok=True)
-    rlogs = []
-    new_routes = []
+RemoteFile = namedtuple("RemoteFile", "name type size mtime")
+class SegmentJob(namedtuple("SegmentJob", "route remote_path size mtime file_type", defaults=("rlog",))):
+    @property
+    def key(self):
+        """State key of the file: "<route>/<file name>"."""
+        return f"{self.route}/{posixpath.basename(self.remote_path)}"
 
-    print("Scanning for new rlogs...")
 
-    try:
-        route_dirs = sorted(sftp.listdir(REALDATA_PATH))
-        total_routes = len(route_dirs)
-        already_uploaded = sum(1 for r in route_dirs if r in uploaded_logs)
+def is_connection_error(e):
+    message = str(e).lower()
+    return "not open" in message or "closed" in message or "connection" in message
 
-        print(f"Found {total_routes} routes total, {already_uploaded} already uploaded")
-        print(f"Checking for {total_routes - already_uploaded} new routes...")
-    except Exception as e:
-        print(f"Error listing routes: {e}")
-        return rlogs, new_routes
 
-    for i, route_name in enumerate(route_dirs, 1):
-        # Skip already uploaded routes
-        if route_name in uploaded_logs:
-            continue
+def format_rate(num_bytes, seconds):
+    return f"{num_bytes / (1024 * 1024) / max(seconds, 1e-6):.2f} MB/s"
 
-        route_path = f"{REALDATA_PATH}/{route_name}"
 
+def open_download_channels(sftp, count):
+    """Open up to `count` SFTP channels on the transport already used by `sftp`."""
+    channels = queue.Queue()
+    channels.put(sftp)
+    opened = 1
+    transport = sftp.get_channel().get_transport()
+    while opened < count:
         try:
-            file_stat = sftp.stat(route_path)
-            if not stat.S_ISDIR(file_stat.st_mode):
-                continue
+            channels.put(open_sftp_channel(transport))
+            opened += 1
         except Exception as e:
-            continue
+            log(f"Could not open extra SFTP channel ({opened} in use): {e}")
+            break
+    return channels, opened
 
-        for rlog_name in ['rlog.zst']:
-            remote_rlog = f"{route_path}/{rlog_name}"
-            try:
-                sftp.stat(remote_rlog)
-                local_route_dir = temp_dir / route_name
-                local_route_dir.mkdir(exist_ok=True)
-                local_rlog = local_route_dir / rlog_name
-
-                print(f"[NEW] Downloading {route_name}/{rlog_name}...")
-                sftp.get(remote_rlog, str(local_rlog))
-                rlogs.append(local_rlog)
-                new_routes.append(route_name)
-                break
 
-            except FileNotFoundError:
+def partial_path(local_rlog):
+    return local_rlog.with_name(local_rlog.name + ".part")
+
+
+def hash_file(path, limit=None):
+    digest = hashlib.sha256()
+    remaining = limit
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE if remaining is None else min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest
+
+
+def fetch_chunked(channel, remote_rlog, part_file, remote_size):
+    """Append the remote file to `part_file` starting at its current length.
+
+    Returns the final length and a SHA-256 of the whole file, hashed while
+    the bytes stream in.
+    """
+    offset = part_file.stat().st_size if part_file.exists() else 0
+    if offset > remote_size:
+        log(f"Discarding partial {part_file.name}: {offset} bytes but remote has {remote_size}")
+        offset = 0
+    if offset:
+        log(f"Resuming {part_file.parent.name}/{part_file.name} at {offset / (1024 * 1024):.2f} MB")
+        metrics.inc("rlog_retries_total", kind="download_resume")
+    digest = hash_file(part_file, offset) if offset else hashlib.sha256()
+    progress = ProgressEmitter("download", f"{part_file.parent.name}/{Path(remote_rlog).name}", remote_size, offset)
+
+    with channel.open(remote_rlog, 'rb') as remote_file, open(part_file, 'r+b' if offset else 'wb') as local_file:
+        local_file.truncate(offset)
+        local_file.seek(offset)
+        remote_file.seek(offset)
+        throttled = bool(download_bucket.rate)
+        if not throttled:
+            remote_file.prefetch(remote_size)
+        while offset < remote_size:
+            check_stopped()
+            length = min(DOWNLOAD_CHUNK_SIZE, remote_size - offset)
+            if throttled:
+                # Request each chunk only once the bucket allows it; a
+                # whole-file prefetch would pull the data in regardless.
+                download_bucket.consume(length)
+                chunk = b"".join(remote_file.readv([(offset, length)]))
+            else:
+                chunk = remote_file.read(length)
+            if not chunk:
+                break
+            local_file.write(chunk)
+            local_file.flush()
+            digest.update(chunk)
+            offset += len(chunk)
+            progress.update(offset)
+    progress.update(offset, force=True)
+    return offset, digest.hexdigest()
+
+
+def download_segment(channels, route_name, remote_rlog, local_rlog, remote_size):
+    if local_rlog.exists() and local_rlog.stat().st_size == remote_size:
+        return 0, 0.0, hash_file(local_rlog).hexdigest()
+
+    part_file = partial_path(local_rlog)
+    resumed_from = part_file.stat().st_size if part_file.exists() else 0
+    channel = channels.get()
+    emit("segment_started", stage="download", route=route_name, file=f"{route_name}/{local_rlog.name}",
+         size=remote_size, resumed_from=resumed_from)
+    try:
+        start = time.monotonic()
+        received, sha256 = fetch_chunked(channel, remote_rlog, part_file, remote_size)
+        elapsed = time.monotonic() - start
+    finally:
+        channels.put(channel)
+
+    if received != remote_size:
+        raise IOError(f"size mismatch: got {received} bytes, remote stat says {remote_size}")
+    part_file.replace(local_rlog)
+    return received - min(resumed_from, received), elapsed, sha256
+
+
+def remote_sha256(sftp, jobs):
+    """Hash every job's file on the device in one exec call; returns {remote_path: hexdigest}.
+
+    Only the first `size` bytes from the manifest are hashed, which is what
+    the download fetched even if the file has grown since. The file list
+    goes over stdin, since a command line holding it overflows the kernel's
+    argument limit after a few hundred segments.
+    """
+    script = 'while read -r size path; do printf \'%s\\t\' "$path"; head -c "$size" "$path" | sha256sum; done'
+    file_list = "".join(f"{job.size} {job.remote_path}\n" for job in jobs)
+    output = run_remote_command(sftp, script, check=False, stdin=file_list.encode())
+    hashes = {}
+    for line in output.decode(errors='replace').splitlines():
+        remote_path, _, digest = line.partition('\t')
+        digest = digest.split(' ')[0]
+        if len(digest) == 64:
+            hashes[remote_path] = digest
+    return hashes
+
+
+def find_corrupt_downloads(remote_hashes, jobs, completed):
+    """Check `completed` against the device's hashes; returns (corrupt, unverified) indexes.
+
+    Corrupt files differ from the device. Unverified ones have no device
+    hash to compare with and must not be accepted either.
+    """
+    try:
+        hashes = remote_hashes.result()
+    except Exception as e:
+        log(f"Warning: could not verify checksums on the device: {e}")
+        return [], list(completed)
+    corrupt, unverified = [], []
+    for index, (_, key, sha256) in completed.items():
+        expected = hashes.get(jobs[index].remote_path)
+        if expected is None:
+            log(f"[UNVERIFIED] {key} has no device checksum")
+            unverified.append(index)
+        elif expected != sha256:
+            log(f"[CORRUPT] {key} checksum mismatch")
+            corrupt.append(index)
+    return corrupt, unverified
+
+
+def download_segments(sftp, jobs, temp_dir, checksums=None, refetch_corrupt=True):
+    """Download SegmentJobs over a pool of SFTP channels.
+
+    Returns the local paths and route names of completed downloads, in job
+    order. A lost connection stops the pool and returns what finished; the
+    interrupted files stay on disk as ".part" and resume on the next attempt.
+    With VERIFY_CHECKSUMS, segments that do not match the device's SHA-256
+    are deleted and fetched once more; verified hashes are added to
+    `checksums` by route name. DOWNLOAD_TRANSPORT = "tar" hands the jobs to
+    download_segments_tar instead.
+    """
+    if not jobs:
+        return [], []
+    if DOWNLOAD_TRANSPORT == "tar":
+        return download_segments_tar(sftp, jobs, temp_dir, checksums, refetch_corrupt)
+
+    remote_hashes = None
+    if VERIFY_CHECKSUMS:
+        # Hash on the device while the transfers run, off the critical path.
+        verify_pool = DaemonExecutor(max_workers=1, thread_name_prefix="verify")
+        remote_hashes = verify_pool.submit(remote_sha256, sftp, jobs)
+        verify_pool.shutdown(wait=False)
+
+    channels, workers = open_download_channels(sftp, min(DOWNLOAD_WORKERS, len(jobs)))
+    log(f"Downloading {len(jobs)} rlogs over {workers} SFTP channels...")
+
+    completed = {}
+    total_bytes = 0
+    connection_lost = stopped = False
+    start = time.monotonic()
+    metrics.inc("rlog_queue_depth", len(jobs), queue="download")
+
+    with DaemonExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+        futures = {}
+        for index, job in enumerate(jobs):
+            local_route_dir = temp_dir / job.route
+            local_route_dir.mkdir(exist_ok=True)
+            local_rlog = local_route_dir / Path(job.remote_path).name
+            future = pool.submit(download_segment, channels, job.route, job.remote_path, local_rlog, job.size)
+            futures[future] = (index, job.key, local_rlog)
+
+        for future in as_completed(futures):
+            index, key, local_rlog = futures[future]
+            metrics.inc("rlog_queue_depth", -1, queue="download")
+            if future.cancelled():
+                # Dropped after a lost connection; nothing went wrong with it
+                continue
+            try:
+                size, elapsed, sha256 = future.result()
+            except EngineStopped:
+                if not stopped:
+                    stopped = True
+                    for pending in futures:
+                        pending.cancel()
                 continue
             except Exception as e:
-                if "not open" in str(e).lower() or "closed" in str(e).lower() or "connection" in str(e).lower():
-                    print(f"\n✗ Connection lost during download!")
-                    print(f"Downloaded {len(rlogs)} new rlogs before disconnect")
-                    return rlogs, new_routes
-                print(f"Error downloading {route_name}/{rlog_name}: {e}")
+                if is_connection_error(e):
+                    if not connection_lost:
+                        log_error(f"\n✗ Connection lost during download!")
+                        connection_lost = True
+                        for pending in futures:
+                            pending.cancel()
+                    continue
+                log_error(f"Error downloading {key}: {e}", file=key)
+                continue
+
+            completed[index] = (local_rlog, key, sha256)
+            total_bytes += size
+            metrics.observe("rlog_segment_bytes", jobs[index].size)
+            if not elapsed:
+                log(f"[{len(completed)}/{len(jobs)}] {key} already downloaded")
                 continue
+            log(f"[{len(completed)}/{len(jobs)}] {key} "
+                  f"{size / (1024 * 1024):.2f} MB in {elapsed:.1f}s ({format_rate(size, elapsed)})")
 
+    while not channels.empty():
+        channel = channels.get()
+        if channel is not sftp:
+            try:
+                channel.close()
+            except:
+                pass
+    if stopped:
+        raise EngineStopped()
+
+    elapsed = time.monotonic() - start
+    record_throughput(total_bytes, elapsed)
+    finish_stage("download", elapsed, bytes=total_bytes, segments=len(completed))
+    metrics.inc("rlog_stage_bytes_total", total_bytes, stage="download")
+    log(f"Downloaded {len(completed)}/{len(jobs)} rlogs, {total_bytes / (1024 * 1024):.2f} MB "
+          f"in {elapsed:.1f}s ({format_rate(total_bytes, elapsed)} aggregate)")
+    if connection_lost:
+        log(f"Downloaded {len(completed)} new rlogs before disconnect")
+
+    return settle_downloads(sftp, jobs, temp_dir, completed, remote_hashes, checksums,
+                            refetch_corrupt and not connection_lost)
+
+
+def settle_downloads(sftp, jobs, temp_dir, completed, remote_hashes, checksums, refetch_corrupt):
+    """Drop downloads that fail verification and return (paths, keys) of the rest in job order.
+
+    `completed` maps job index to (local path, key, sha256). Corrupt files
+    are deleted and, with `refetch_corrupt`, downloaded once more. Files
+    that could not be verified stay on disk unreported, so the next cycle
+    checks them again without downloading them.
+    """
+    corrupt, unverified = [], []
+    if remote_hashes and completed:
+        corrupt, unverified = find_corrupt_downloads(remote_hashes, jobs, completed)
+    for index in corrupt:
+        completed.pop(index)[0].unlink()
+    for index in unverified:
+        completed.pop(index)
+
+    rlogs = [completed[i][0] for i in sorted(completed)]
+    new_routes = [completed[i][1] for i in sorted(completed)]
+    if checksums is not None:
+        checksums.update((key, sha256) for _, key, sha256 in completed.values())
+
+    if corrupt and refetch_corrupt:
+        log(f"Re-fetching {len(corrupt)} corrupt rlogs...")
+        metrics.inc("rlog_retries_total", len(corrupt), kind="download_corrupt")
+        retry_rlogs, retry_routes = download_segments(
+            sftp, [jobs[i] for i in corrupt], temp_dir, checksums, refetch_corrupt=False
+        )
+        rlogs += retry_rlogs
+        new_routes += retry_routes
     return rlogs, new_routes
 
 
-def create_zip(rlogs, dongle_id, output_dir, temp_dir):
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    zip_filename = output_dir / f"{dongle_id}-rlogs-{timestamp}.zip"
-    print(f"\nCreating {zip_filename}...")
-    print(f"Compressing {len(rlogs)} rlog files...")
+def tar_compression():
+    """The TAR_COMPRESSION to use, or None when it cannot be decoded here."""
+    if TAR_COMPRESSION == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            log("Warning: TAR_COMPRESSION = 'zstd' needs the zstandard package; sending the tar stream uncompressed")
+            return None
+    return TAR_COMPRESSION
+
+
+def tar_sources(sftp, jobs):
+    """Yield (index, job, reader) for each file of one device-side tar stream.
+
+    Runs `tar` over every job's file on a single exec channel, passing the
+    file list on stdin so it is not bound by the command-line length limit.
+    Each reader must be consumed before the next file is requested. Files that vanished
+    or shrank since the scan are skipped; a file that grew is read up to
+    its scanned size like the SFTP path does.
+    """
+    compression = tar_compression()
+    command = f"tar -C {shlex.quote(REALDATA_PATH)} -cf - -T -"
+    if compression:
+        command += f" | {compression} -1 -c"
+    pending = {job.key: (index, job) for index, job in enumerate(jobs)}
+
+    channel = sftp.get_channel().get_transport().open_session(
+        window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE
+    )
+    try:
+        channel.exec_command(command)
+        channel.sendall("".join(f"{job.key}\n" for job in jobs).encode())
+        channel.shutdown_write()
+        stream = channel.makefile('rb')
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=stream)
+        elif compression == "zstd":
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        with tarfile.open(fileobj=stream, mode='r|', bufsize=DOWNLOAD_CHUNK_SIZE) as archive:
+            for member in archive:
+                index, job = pending.pop(member.name, (None, None))
+                if job is None or not member.isfile():
+                    continue
+                if member.size < job.size:
+                    log(f"  {job.key} shrank to {member.size} of {job.size} bytes, skipping")
+                    continue
+                yield index, job, archive.extractfile(member)
+        if pending:
+            error = channel.makefile_stderr('rb').read().decode(errors='replace').strip()
+            log(f"Warning: tar did not send {len(pending)} files: {error or f'exit status {channel.recv_exit_status()}'}")
+    finally:
+        channel.close()
+
+
+def download_segments_tar(sftp, jobs, temp_dir, checksums=None, refetch_corrupt=True):
+    """Download SegmentJobs as one tar stream; same contract as download_segments.
+
+    Files already complete locally are left out of the stream. A lost
+    connection returns what finished; the interrupted file is fetched from
+    the start next time.
+    """
+    if not jobs:
+        return [], []
+
+    remote_hashes = None
+    if VERIFY_CHECKSUMS:
+        verify_pool = DaemonExecutor(max_workers=1, thread_name_prefix="verify")
+        remote_hashes = verify_pool.submit(remote_sha256, sftp, jobs)
+        verify_pool.shutdown(wait=False)
+
+    completed = {}
+    pending = []
+    for index, job in enumerate(jobs):
+        local_rlog = temp_dir / job.route / posixpath.basename(job.remote_path)
+        if local_rlog.exists() and local_rlog.stat().st_size == job.size:
+            completed[index] = (local_rlog, job.key, hash_file(local_rlog).hexdigest())
+            metrics.observe("rlog_segment_bytes", job.size)
+            log(f"[{len(completed)}/{len(jobs)}] {job.key} already downloaded")
+        else:
+            pending.append(index)
+
+    log(f"Downloading {len(pending)} rlogs as one tar stream...")
+    fetched = total_bytes = 0
+    connection_lost = False
+    start = time.monotonic()
+    metrics.inc("rlog_queue_depth", len(pending), queue="download")
+
+    try:
+        sources = tar_sources(sftp, [jobs[index] for index in pending]) if pending else ()
+        for i, job, reader in sources:
+            local_rlog = temp_dir / job.route / posixpath.basename(job.remote_path)
+            local_rlog.parent.mkdir(exist_ok=True)
+            part_file = partial_path(local_rlog)
+            emit("segment_started", stage="download", route=job.route, file=job.key, size=job.size, resumed_from=0)
+            progress = ProgressEmitter("download", job.key, job.size)
+            digest = hashlib.sha256()
+            received = 0
+            file_start = time.monotonic()
+            with open(part_file, 'wb') as local_file:
+                while received < job.size:
+                    check_stopped()
+                    chunk = reader.read(min(DOWNLOAD_CHUNK_SIZE, job.size - received))
+                    if not chunk:
+                        break
+                    download_bucket.consume(len(chunk))
+                    local_file.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+                    progress.update(received)
+            progress.update(received, force=True)
+            if received != job.size:
+                raise IOError(f"{job.key} ended at {received} of {job.size} bytes")
+            part_file.replace(local_rlog)
+            elapsed = time.monotonic() - file_start
+
+            completed[pending[i]] = (local_rlog, job.key, digest.hexdigest())
+            fetched += 1
+            total_bytes += received
+            metrics.inc("rlog_queue_depth", -1, queue="download")
+            metrics.observe("rlog_segment_bytes", job.size)
+            log(f"[{len(completed)}/{len(jobs)}] {job.key} "
+                f"{received / (1024 * 1024):.2f} MB in {elapsed:.1f}s ({format_rate(received, elapsed)})")
+    except Exception as e:
+        # A broken tar stream usually means the connection went away under it
+        if is_connection_error(e) or not sftp.get_channel().get_transport().is_active():
+            log_error(f"\n✗ Connection lost during download!")
+            connection_lost = True
+        else:
+            log_error(f"Error in tar stream: {e}")
+    metrics.inc("rlog_queue_depth", fetched - len(pending), queue="download")
+
+    elapsed = time.monotonic() - start
+    record_throughput(total_bytes, elapsed)
+    finish_stage("download", elapsed, bytes=total_bytes, segments=len(completed))
+    metrics.inc("rlog_stage_bytes_total", total_bytes, stage="download")
+    log(f"Downloaded {len(completed)}/{len(jobs)} rlogs, {total_bytes / (1024 * 1024):.2f} MB "
+        f"in {elapsed:.1f}s ({format_rate(total_bytes, elapsed)})")
+    if connection_lost:
+        log(f"Downloaded {len(completed)} new rlogs before disconnect")
+
+    return settle_downloads(sftp, jobs, temp_dir, completed, remote_hashes, checksums,
+                            refetch_corrupt and not connection_lost)
+
+
+def run_remote_command(sftp, command, check=True, stdin=None):
+    """Run `command` on the device over the SFTP session's transport and return stdout.
+
+    `stdin` (bytes) is written to the command's standard input, then closed.
+    """
+    channel = sftp.get_channel().get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        if stdin is not None:
+            channel.sendall(stdin)
+            channel.shutdown_write()
+        output = channel.makefile('rb').read()
+        error = channel.makefile_stderr('rb').read()
+        exit_status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if check and exit_status != 0:
+        raise IOError(f"'{command.split()[0]}' exited with {exit_status}: {error.decode(errors='replace').strip()}")
+    return output
+
+
+def manifest_from_find(sftp):
+    # One exec round trip for the device clock, every route directory and
+    # the files inside it.
+    output = run_remote_command(
+        sftp,
+        f"date +%s; find {shlex.quote(REALDATA_PATH)} -mindepth 1 -maxdepth 2 -printf '%y\\t%s\\t%T@\\t%P\\n'"
+    )
+    lines = output.decode(errors='replace').splitlines()
+    device_time = float(lines.pop(0)) if lines and lines[0].isdigit() else None
+    manifest = {}
+    for line in lines:
+        try:
+            file_type, size, mtime, rel_path = line.split('\t', 3)
+        except ValueError:
+            continue
+        route_name, _, name = rel_path.partition('/')
+        if not name:
+            if file_type == 'd':
+                manifest.setdefault(route_name, {})
+            continue
+        manifest.setdefault(route_name, {})[name] = RemoteFile(name, file_type, int(size), float(mtime))
+    return manifest, device_time
+
+
+def manifest_from_listdir(sftp):
+    manifest = {}
+    for route_attr in sftp.listdir_attr(REALDATA_PATH):
+        if not stat.S_ISDIR(route_attr.st_mode):
+            continue
+        route_path = f"{REALDATA_PATH}/{route_attr.filename}"
+        manifest[route_attr.filename] = {
+            a.filename: RemoteFile(a.filename, 'd' if stat.S_ISDIR(a.st_mode) else 'f', a.st_size, a.st_mtime)
+            for a in sftp.listdir_attr(route_path)
+        }
+    return manifest, None
+
+
+def fetch_remote_manifest(sftp):
+    """Return {route_name: {file_name: RemoteFile}} for everything under REALDATA_PATH.
+
+    Uses a single remote `find -printf`; falls back to SFTP directory
+    listings when the device's find does not support it. Also returns the
+    device's clock in epoch seconds, or None from the fallback.
+    """
+    start = time.monotonic()
+    try:
+        manifest, device_time = manifest_from_find(sftp)
+    except Exception as e:
+        if is_connection_error(e):
+            raise
+        log(f"Remote find failed ({e}), falling back to SFTP listing")
+        manifest, device_time = manifest_from_listdir(sftp)
+    file_count = sum(len(files) for files in manifest.values())
+    log(f"Manifest: {len(manifest)} routes, {file_count} files in {time.monotonic() - start:.2f}s")
+    return manifest, device_time
+
+
+def segment_key(route_name):
+    """Split a segment directory name like "00000012--3a8c1d4e2f--4" into (route, index)."""
+    route, _, index = route_name.rpartition("--")
+    return (route, int(index)) if index.isdigit() else (route_name, 0)
+
+
+def order_by_route(jobs):
+    routes = {}
+    for job in jobs:
+        routes.setdefault(segment_key(job.route)[0], []).append(job)
+    ordered = []
+    for route_jobs in sorted(routes.values(), key=lambda js: max(j.mtime for j in js), reverse=True):
+        ordered.extend(sorted(route_jobs, key=lambda j: segment_key(j.route)[1]))
+    return ordered
+
+
+SCHEDULE_POLICIES = {
+    "newest": lambda jobs: sorted(jobs, key=lambda j: j.mtime, reverse=True),
+    "oldest": lambda jobs: sorted(jobs, key=lambda j: j.mtime),
+    "smallest": lambda jobs: sorted(jobs, key=lambda j: j.size),
+    "route": order_by_route,
+}
+
+
+class TokenBucket:
+    """Thread-safe token bucket; consume() blocks until `num_bytes` fit under `rate` bytes/s."""
+
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst or max(rate, DOWNLOAD_CHUNK_SIZE)
+            self.tokens = self.burst
+            self.updated = time.monotonic()
+
+    def consume(self, num_bytes):
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= num_bytes:
+                    self.tokens -= num_bytes
+                    return
+                wait = (num_bytes - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+download_bucket = TokenBucket(BANDWIDTH_LIMIT)
+# Last (size, mtime) seen for each file of a segment being written, with the
+# monotonic time it was first seen; see is_settled().
+segment_probes = {}
+# Exponentially weighted download throughput in bytes/s, None until measured.
+# Saved to the state DB after each sync so a restart keeps the estimate.
+measured_throughput = None
+
+
+def record_throughput(num_bytes, seconds):
+    global measured_throughput
+    if num_bytes < DOWNLOAD_CHUNK_SIZE or seconds <= 0:
+        return
+    rate = num_bytes / seconds
+    measured_throughput = rate if measured_throughput is None else 0.7 * measured_throughput + 0.3 * rate
+
+
+def restore_throughput(store):
+    """Seed measured_throughput from the state DB when nothing has been measured yet."""
+    global measured_throughput
+    if measured_throughput is None:
+        measured_throughput = store.get_estimate("download_throughput")
+
+
+def save_throughput(store):
+    if measured_throughput is not None:
+        store.set_estimate("download_throughput", measured_throughput)
+
+
+def schedule_jobs(jobs, policy=None, budget_seconds=None):
+    """Order jobs by SCHEDULE_POLICY and trim them to the time budget, if any."""
+    policy = policy or SCHEDULE_POLICY
+    budget_seconds = TIME_BUDGET_SECONDS if budget_seconds is None else budget_seconds
+    if policy not in SCHEDULE_POLICIES:
+        log(f"Unknown schedule policy {policy!r}, using oldest first")
+        policy = "oldest"
+    # Stable, so the policy's order holds within each file type priority
+    jobs = sorted(SCHEDULE_POLICIES[policy](jobs), key=lambda job: file_type_priority(job.file_type))
+    if not jobs:
+        return jobs
+
+    total_bytes = sum(job.size for job in jobs)
+    rate = measured_throughput
+    if download_bucket.rate:
+        rate = min(rate or download_bucket.rate, download_bucket.rate)
+    if not rate:
+        log(f"Scheduled {len(jobs)} rlogs ({total_bytes / (1024 * 1024):.2f} MB, {policy} first)")
+        if budget_seconds:
+            log(f"Time budget {budget_seconds}s skipped: no download throughput measured yet")
+        return jobs
+
+    log(f"Scheduled {len(jobs)} rlogs ({total_bytes / (1024 * 1024):.2f} MB, {policy} first), "
+          f"estimated {total_bytes / rate:.0f}s at {rate / (1024 * 1024):.2f} MB/s")
+    if budget_seconds:
+        fitting, budget_bytes, planned = [], budget_seconds * rate, 0
+        for job in jobs:
+            if planned + job.size > budget_bytes and fitting:
+                continue
+            fitting.append(job)
+            planned += job.size
+        if len(fitting) < len(jobs):
+            log(f"Time budget {budget_seconds}s: fetching {len(fitting)} rlogs now, "
+                  f"deferring {len(jobs) - len(fitting)}")
+        jobs = fitting
+    return jobs
+
+
+def select_files(route_name, files, file_types=None):
+    """Pick each FILE_TYPES entry's file from a segment's {file_name: RemoteFile}.
+
+    Returns [(file_type, file_name, RemoteFile)]; files over the type's
+    max_bytes are reported and left out.
+    """
+    selected = []
+    for file_type in file_types or FILE_TYPES:
+        for name in sorted(files):
+            entry = files[name]
+            if entry.type != 'f' or not fnmatch.fnmatch(name, file_type["pattern"]):
+                continue
+            max_bytes = file_type.get("max_bytes")
+            if max_bytes is not None and entry.size > max_bytes:
+                log(f"[SKIP] {route_name}/{name}: {entry.size / (1024 * 1024):.1f} MB is over the {file_type['name']} cap")
+            else:
+                selected.append((file_type["name"], name, entry))
+            break
+    return selected
+
+
+def file_type_priority(name):
+    for file_type in FILE_TYPES:
+        if file_type["name"] == name:
+            return file_type.get("priority", 0)
+    return 0
+
+
+def newest_segment(route_dirs):
+    """The segment directory openpilot may still be writing: the last one of the newest route."""
+    segments = [segment_key(name) + (name,) for name in route_dirs]
+    return max(segments)[2] if segments else None
+
+
+def is_settled(remote_path, entry, device_time):
+    """True once a file has not changed for SEGMENT_SETTLE_SECONDS.
+
+    The device clock against the file's mtime answers in one scan; without
+    it, or if the clock is behind, the file must keep its size and mtime
+    across scans at least that far apart.
+    """
+    if not SEGMENT_SETTLE_SECONDS:
+        return True
+    if device_time is not None and device_time - entry.mtime >= SEGMENT_SETTLE_SECONDS:
+        segment_probes.pop(remote_path, None)
+        return True
+    now = time.monotonic()
+    size, mtime, since = segment_probes.get(remote_path, (None, None, now))
+    if (size, mtime) != (entry.size, entry.mtime):
+        segment_probes[remote_path] = (entry.size, entry.mtime, now)
+        return False
+    if now - since < SEGMENT_SETTLE_SECONDS:
+        return False
+    segment_probes.pop(remote_path)
+    return True
+
+
+def scan_new_rlogs(sftp, uploaded_logs, deferred=None):
+    """Return SegmentJobs for FILE_TYPES files not yet uploaded.
+
+    `uploaded_logs` is a set of file keys ("<route>/<file name>") or, from
+    SegmentStore, a dict of key to uploaded size; with sizes, a file that has
+    changed size since its upload is fetched again. Files of the newest
+    segment that are still being written are left out and their keys added
+    to `deferred`.
+    """
+    jobs = []
+
+    log("Scanning for new rlogs...")
+
+    try:
+        manifest, device_time = fetch_remote_manifest(sftp)
+        route_dirs = sorted(manifest)
+        total_routes = len(route_dirs)
+        already_uploaded = len({key.split("/")[0] for key in uploaded_logs} & set(route_dirs))
+
+        log(f"Found {total_routes} routes total, {already_uploaded} with files already uploaded")
+    except Exception as e:
+        log(f"Error listing routes: {e}")
+        return jobs
+
+    writing = newest_segment(route_dirs)
+    for route_name in route_dirs:
+        for file_type, file_name, entry in select_files(route_name, manifest[route_name]):
+            key = f"{route_name}/{file_name}"
+            # Skip already uploaded files
+            if key in uploaded_logs:
+                uploaded_size = uploaded_logs[key] if isinstance(uploaded_logs, dict) else None
+                if uploaded_size is None or uploaded_size == entry.size:
+                    continue
+                status = f"[CHANGED] {key} ({uploaded_size} -> {entry.size} bytes)"
+            else:
+                status = f"[NEW] {key}"
+            if route_name == writing and not is_settled(f"{REALDATA_PATH}/{key}", entry, device_time):
+                log(f"[WRITING] {key} is still being written, deferring")
+                if deferred is not None:
+                    deferred.append(key)
+                continue
+            log(status)
+            jobs.append(SegmentJob(route_name, f"{REALDATA_PATH}/{key}", entry.size, entry.mtime, file_type))
+
+    return jobs
+
+
+def choose_compression(head, method=None):
+    """Pick the zip compression for a file from its first bytes."""
+    method = method or ZIP_COMPRESSION
+    if method == "store":
+        return zipfile.ZIP_STORED
+    if method == "deflate":
+        return zipfile.ZIP_DEFLATED
+    if head.startswith(COMPRESSED_MAGIC):
+        return zipfile.ZIP_STORED
+    probe = head[:COMPRESSION_PROBE_BYTES]
+    if probe and len(zlib.compress(probe, 1)) < len(probe) * COMPRESSION_MIN_RATIO:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+def read_head(path):
+    with open(path, 'rb') as f:
+        return f.read(COMPRESSION_PROBE_BYTES)
+
+
+def write_rlogs_zip(zip_filename, rlogs, method=None):
     with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
         for i, rlog_path in enumerate(rlogs, 1):
             arcname = f"{rlog_path.parent.name}/{rlog_path.name}"
-            print(f"[{i}/{len(rlogs)}] Adding {arcname}")
-            zipf.write(rlog_path, arcname=arcname)
-    import shutil
-    shutil.rmtree(temp_dir)
-    file_size = zip_filename.stat().st_size / (1024 * 1024)
-    print(f"\nDone! Created {zip_filename}")
-    print(f"Size: {file_size:.2f} MB")
-    return zip_filename
+            compress_type = choose_compression(read_head(rlog_path), method)
+            label = "stored" if compress_type == zipfile.ZIP_STORED else "deflated"
+            log(f"[{i}/{len(rlogs)}] Adding {arcname} ({label})")
+            zipf.write(rlog_path, arcname=arcname, compress_type=compress_type)
+
+
+def split_into_parts(rlogs, routes, max_bytes):
+    """Group (rlog, route) pairs, in order, into parts of at most `max_bytes` input bytes."""
+    parts = []
+    part_bytes = 0
+    for rlog_path, route_name in zip(rlogs, routes):
+        size = rlog_path.stat().st_size
+        if not parts or (max_bytes and part_bytes + size > max_bytes and parts[-1][0]):
+            parts.append(([], []))
+            part_bytes = 0
+        parts[-1][0].append(rlog_path)
+        parts[-1][1].append(route_name)
+        part_bytes += size
+    return parts
+
+
+def create_zip_parts(rlogs, routes, dongle_id, output_dir):
+    """Package downloaded rlogs into one or more zips of at most ARCHIVE_PART_MAX_BYTES.
+
+    Returns a list of (zip_path, routes_in_part).
+    """
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    parts = split_into_parts(rlogs, routes, ARCHIVE_PART_MAX_BYTES)
+    archives = []
+    for number, (part_rlogs, part_routes) in enumerate(parts, 1):
+        suffix = f"-part{number:02d}" if len(parts) > 1 else ""
+        zip_filename = output_dir / f"{dongle_id}-rlogs-{timestamp}{suffix}.zip"
+        log(f"\nCreating {zip_filename}...")
+        log(f"Packaging {len(part_rlogs)} rlog files...")
+        metrics.inc("rlog_stage_bytes_total", sum(p.stat().st_size for p in part_rlogs), stage="zip")
+        with timed_stage("zip"):
+            write_rlogs_zip(zip_filename, part_rlogs)
+        # Only remove what went into the zip; ".part" files of interrupted
+        # downloads are kept so the next connection can resume them.
+        for rlog_path in part_rlogs:
+            rlog_path.unlink()
+            try:
+                rlog_path.parent.rmdir()
+            except OSError:
+                pass
+        file_size = zip_filename.stat().st_size / (1024 * 1024)
+        log(f"Done! Created {zip_filename}")
+        log(f"Size: {file_size:.2f} MB")
+        archives.append((zip_filename, part_routes))
+    return archives
+
+
+def login_filebrowser(client=None):
+    """Return a valid FileBrowser token, logging in only if the cached one is missing or expiring."""
+    try:
+        return (client or filebrowser).get_token()
+    except Exception as e:
+        log(f"✗ Login error: {e}")
+        return None
+
+
+class TusNotSupported(Exception):
+    pass
+
+
+http_session = None
 
 
-def login_filebrowser():
-    print("\nLogging in to FileBrowser...")
+def get_http_session():
+    """Shared requests session whose connection pool covers UPLOAD_WORKERS parallel uploads."""
+    global http_session
+    if http_session is None:
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(UPLOAD_WORKERS, 1) * 2)
+        http_session.mount("https://", adapter)
+        http_session.mount("http://", adapter)
+        http_session.verify = False
+    return http_session
 
-    login_url = f"{BASE_URL}/api/login"
 
+def jwt_expiry(token):
+    """Unix time from the `exp` claim of a JWT, or None if it has none."""
     try:
-        response = requests.post(
-            login_url,
-            json={
-                "username": USERNAME,
-                "password": PASSWORD
-            },
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class FileBrowserAuthError(Exception):
+    pass
+
+
+class FileBrowserClient:
+    """FileBrowser API access over the shared session with a cached auth token.
+
+    The token is renewed TOKEN_RENEW_MARGIN seconds before its JWT expiry, and
+    a 401 response triggers one fresh login and a retry of the request.
+    """
+
+    def __init__(self, base_url=None, upload_path=None, username=None, password=None):
+        self.settings = {"base_url": base_url, "upload_path": upload_path, "username": username, "password": password}
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+
+    # Unset account settings follow the module-level ones
+    @property
+    def base_url(self):
+        return self.settings["base_url"] or BASE_URL
+
+    @property
+    def upload_path(self):
+        return self.settings["upload_path"] or UPLOAD_PATH
+
+    def reset(self):
+        with self.lock:
+            self.token = None
+            self.expires_at = 0
+
+    def invalidate(self, token):
+        with self.lock:
+            # Another thread may already have replaced it
+            if self.token == token:
+                self.token = None
+                self.expires_at = 0
+
+    def get_token(self):
+        with self.lock:
+            now = time.time()
+            if self.token and now < self.expires_at - TOKEN_RENEW_MARGIN:
+                return self.token
+            if self.token and now < self.expires_at and self._renew():
+                return self.token
+            return self._login()
+
+    def _login(self):
+        log("\nLogging in to FileBrowser...")
+        with timed_stage("login"):
+            response = get_http_session().post(
+                f"{self.base_url}/api/login",
+                json={
+                    "username": self.settings["username"] or USERNAME,
+                    "password": self.settings["password"] or PASSWORD
+                },
+                verify=False,
+                timeout=30
+            )
+        if response.status_code != 200:
+            raise FileBrowserAuthError(f"login failed: {response.text[:200]}")
+        log("✓ Login successful!")
+        return self._set_token(response.text.strip('"'))
+
+    def _renew(self):
+        try:
+            response = get_http_session().post(
+                f"{self.base_url}/api/renew",
+                headers={"X-Auth": self.token},
+                verify=False,
+                timeout=30
+            )
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        return self._set_token(response.text.strip('"'))
+
+    def _set_token(self, token):
+        self.token = token
+        # Tokens without an expiry are kept until the server rejects them
+        self.expires_at = jwt_expiry(token) or float("inf")
+        return token
+
+    def request(self, method, url, headers=None, retry_auth=True, **kwargs):
+        """Send `method` to `url` with the auth header; pass retry_auth=False for one-shot bodies."""
+        token = self.get_token()
+        headers = dict(headers or {})
+        response = get_http_session().request(method, url, headers={**headers, "X-Auth": token}, **kwargs)
+        if response.status_code == 401 and retry_auth:
+            log("FileBrowser token rejected, logging in again")
+            metrics.inc("rlog_retries_total", kind="auth")
+            self.invalidate(token)
+            body = kwargs.get("data")
+            if hasattr(body, "seek"):
+                body.seek(0)
+            response = get_http_session().request(
+                method, url, headers={**headers, "X-Auth": self.get_token()}, **kwargs
+            )
+        return response
+
+
+filebrowser = FileBrowserClient()
+uplink_slots = threading.BoundedSemaphore(UPLINK_CONCURRENCY)
+
+
+def upload_part(local_file, client):
+    with uplink_slots:
+        return upload_to_filebrowser(local_file, client)
+
+
+def upload_parts(archives, on_uploaded=None, client=None):
+    """Upload (zip_path, routes) parts in parallel; only failed parts are retried.
+
+    `on_uploaded(zip_path, routes, seconds)` is called as soon as each part
+    lands. Returns the parts that still failed after UPLOAD_PART_ATTEMPTS
+    rounds.
+    """
+    def timed_upload(zip_path):
+        part_start = time.monotonic()
+        return upload_part(zip_path, client), time.monotonic() - part_start
+
+    pending = list(archives)
+    start = time.monotonic()
+    stopped = False
+    for attempt in range(1, UPLOAD_PART_ATTEMPTS + 1):
+        if not pending or stopped:
+            break
+        if attempt > 1:
+            log(f"\nRetrying {len(pending)} failed parts (attempt {attempt}/{UPLOAD_PART_ATTEMPTS})...")
+            metrics.inc("rlog_retries_total", len(pending), kind="upload_part")
+        metrics.inc("rlog_queue_depth", len(pending), queue="upload")
+        failed = []
+        with DaemonExecutor(max_workers=max(1, min(UPLOAD_WORKERS, len(pending))),
+                            thread_name_prefix="upload") as pool:
+            futures = {pool.submit(timed_upload, zip_path): (zip_path, routes)
+                       for zip_path, routes in pending}
+            for future in as_completed(futures):
+                zip_path, routes = futures[future]
+                metrics.inc("rlog_queue_depth", -1, queue="upload")
+                try:
+                    upload_url, seconds = future.result()
+                except EngineStopped:
+                    # Keep marking the parts that landed before the stop
+                    stopped = True
+                    upload_url = None
+                except Exception as e:
+                    log_error(f"✗ Upload error for {zip_path.name}: {e}", file=zip_path.name)
+                    upload_url = None
+                if upload_url:
+                    metrics.inc("rlog_stage_bytes_total", zip_path.stat().st_size, stage="upload")
+                    if on_uploaded:
+                        on_uploaded(zip_path, routes, seconds)
+                else:
+                    failed.append((zip_path, routes))
+        pending = failed
+    if stopped:
+        raise EngineStopped()
+    finish_stage("upload", time.monotonic() - start, parts=len(archives) - len(pending))
+    return pending
+
+
+def load_upload_progress():
+    if UPLOAD_PROGRESS_FILE.exists():
+        try:
+            with open(UPLOAD_PROGRESS_FILE, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            log(f"Warning: Failed to read upload progress: {e}")
+    return {}
+
+
+def save_upload_progress(progress):
+    tmp_file = UPLOAD_PROGRESS_FILE.with_name(UPLOAD_PROGRESS_FILE.name + ".tmp")
+    with open(tmp_file, 'w') as f:
+        json.dump(progress, f, indent=2)
+    tmp_file.replace(UPLOAD_PROGRESS_FILE)
+
+
+upload_progress_lock = threading.Lock()
+
+
+def record_upload_offset(local_file, size, offset):
+    with upload_progress_lock:
+        progress = load_upload_progress()
+        if offset is None:
+            progress.pop(local_file.name, None)
+        else:
+            progress[local_file.name] = {"size": size, "offset": offset, "updated": time.time()}
+        save_upload_progress(progress)
+
+
+def tus_server_offset(tus_url, headers, client=None):
+    response = (client or filebrowser).request("HEAD", tus_url, headers=headers, verify=False, timeout=30)
+    if response.status_code != 200:
+        return None
+    return int(response.headers.get("Upload-Offset", 0))
+
+
+def upload_resumable(local_file, client=None):
+    """Upload `local_file` through FileBrowser's TUS endpoint in UPLOAD_CHUNK_SIZE chunks.
+
+    The last acknowledged offset is kept in UPLOAD_PROGRESS_FILE, so a later
+    call for the same archive continues where the previous one stopped.
+    Raises TusNotSupported if the server has no TUS endpoint.
+    """
+    client = client or filebrowser
+    tus_url = f"{client.base_url}/api/tus{client.upload_path}{local_file.name}"
+    headers = {"Tus-Resumable": "1.0.0"}
+    size = local_file.stat().st_size
+
+    offset = None
+    record = load_upload_progress().get(local_file.name)
+    if record and record.get("size") == size:
+        offset = tus_server_offset(tus_url, headers, client)
+        if offset is not None and offset <= size:
+            log(f"Resuming upload at {offset / (1024 * 1024):.2f} MB")
+        else:
+            offset = None
+
+    if offset is None:
+        response = client.request(
+            "POST",
+            f"{tus_url}?override=true",
+            headers={**headers, "Upload-Length": str(size)},
             verify=False,
             timeout=30
         )
+        if response.status_code in [404, 405]:
+            raise TusNotSupported()
+        if response.status_code not in [200, 201]:
+            log(f"✗ Upload failed: {response.text[:200]}")
+            return False
+        offset = 0
+    record_upload_offset(local_file, size, offset)
+
+    failures = 0
+    start = time.monotonic()
+    start_offset = offset
+    progress = ProgressEmitter("upload", local_file.name, size, offset)
+    with open(local_file, 'rb') as f:
+        while offset < size:
+            check_stopped()
+            f.seek(offset)
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            try:
+                response = client.request(
+                    "PATCH",
+                    tus_url,
+                    headers={
+                        **headers,
+                        "Upload-Offset": str(offset),
+                        "Content-Type": "application/offset+octet-stream"
+                    },
+                    data=chunk,
+                    verify=False,
+                    timeout=120
+                )
+                error = None if response.status_code in [200, 204] else f"HTTP {response.status_code} {response.text[:200]}"
+            except Exception as e:
+                error = str(e)
+
+            if error is None:
+                offset = int(response.headers.get("Upload-Offset", offset + len(chunk)))
+                record_upload_offset(local_file, size, offset)
+                progress.update(offset, force=offset >= size)
+                failures = 0
+                log(f"  {local_file.name}: {offset / (1024 * 1024):.1f}/{size / (1024 * 1024):.1f} MB "
+                      f"({format_rate(offset - start_offset, time.monotonic() - start)})")
+                continue
 
-        if response.status_code == 200:
-            token = response.text.strip('"')
-            print("✓ Login successful!")
-            return token
-        else:
-            print(f"✗ Login failed: {response.text}")
-            return None
+            failures += 1
+            metrics.inc("rlog_retries_total", kind="upload_chunk")
+            if failures > UPLOAD_RETRIES:
+                log_error(f"✗ Upload failed at {offset / (1024 * 1024):.2f} MB: {error}", file=local_file.name)
+                return False
+            delay = min(UPLOAD_RETRY_DELAY * 2 ** (failures - 1), 60)
+            log(f"Chunk at {offset} failed ({error}), retrying in {delay}s...")
+            stop_requested.wait(delay)
+            check_stopped()
+            try:
+                server_offset = tus_server_offset(tus_url, headers, client)
+                if server_offset is not None:
+                    offset = server_offset
+            except Exception:
+                pass
 
-    except Exception as e:
-        print(f"✗ Login error: {e}")
-        return None
+    record_upload_offset(local_file, size, None)
+    return True
 
 
-def upload_to_filebrowser(token, local_file):
-    print(f"\nUploading {local_file.name} ({local_file.stat().st_size / (1024 * 1024):.2f} MB)...")
-    print("This may take several minutes...")
+def upload_to_filebrowser(local_file, client=None):
+    client = client or filebrowser
+    log(f"\nUploading {local_file.name} ({local_file.stat().st_size / (1024 * 1024):.2f} MB)...")
+    log("This may take several minutes...")
 
-    upload_url = f"{BASE_URL}/api/resources{UPLOAD_PATH}{local_file.name}"
+    if UPLOAD_CHUNK_SIZE:
+        try:
+            if upload_resumable(local_file, client):
+                view_url = f"{client.base_url}{client.upload_path}{local_file.name}"
+                log(f"✓ Upload complete!")
+                log(f"URL: {view_url}")
+                return view_url
+            return None
+        except TusNotSupported:
+            log("Server has no TUS endpoint, falling back to a single upload")
+        except Exception as e:
+            log(f"✗ Upload error: {e}")
+            return None
+
+    upload_url = f"{client.base_url}/api/resources{client.upload_path}{local_file.name}"
 
     try:
         with open(local_file, 'rb') as f:
-            response = requests.post(
+            response = client.request(
+                "POST",
                 upload_url,
-                headers={
-                    "X-Auth": token
-                },
                 data=f,
                 verify=False,
                 timeout=600
             )
 
         if response.status_code in [200, 201]:
-            view_url = f"{BASE_URL}{UPLOAD_PATH}{local_file.name}"
-            print(f"✓ Upload complete!")
-            print(f"URL: {view_url}")
+            view_url = f"{client.base_url}{client.upload_path}{local_file.name}"
+            log(f"✓ Upload complete!")
+            log(f"URL: {view_url}")
             return view_url
         else:
-            print(f"✗ Upload failed: {response.text[:200]}")
+            log(f"✗ Upload failed: {response.text[:200]}")
             return None
 
     except Exception as e:
-        print(f"✗ Upload error: {e}")
+        log(f"✗ Upload error: {e}")
         return None
 
 
-if __name__ == "__main__":
-    print("=" * 60)
-    print("Comma 3X Rlog Auto-Uploader")
-    print("=" * 60)
-    print("Monitoring for new logs and auto-uploading...")
-    print("Press Ctrl+C to stop\n")
+class StreamBuffer:
+    """Write-only file object that hands fixed-size chunks to a reader through a bounded queue.
 
-    uploaded_logs = load_uploaded_logs()
-    print(f"Loaded tracking file: {len(uploaded_logs)} routes already uploaded\n")
+    The writer blocks once `max_chunks` chunks are waiting, which keeps memory
+    bounded and makes the slowest stage set the pace of the whole pipeline.
+    """
 
-    try:
+    def __init__(self, max_chunks, chunk_size):
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.chunk_size = chunk_size
+        self.pending = bytearray()
+        self.aborted = threading.Event()
+
+    def _put(self, item):
         while True:
-            wait_for_comma()
+            if self.aborted.is_set():
+                raise IOError("stream reader went away")
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
 
-            print("\nConnecting to Comma 3X...")
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= self.chunk_size:
+            self._put(bytes(self.pending))
+            self.pending.clear()
+        return len(data)
 
-            try:
-                ssh, sftp = connect_sftp()
-                print("Connected!")
+    def flush(self):
+        pass
 
-                dongle_id = get_dongle_id(sftp)
-                print(f"Dongle ID: {dongle_id}")
+    def close(self):
+        if self.pending:
+            self._put(bytes(self.pending))
+            self.pending.clear()
+        self._put(None)
 
-                rlogs, new_routes = download_new_rlogs(sftp, LOCAL_TEMP_DIR, uploaded_logs)
+    def fail(self, error):
+        try:
+            self._put(error)
+        except IOError:
+            pass
 
-                try:
-                    sftp.close()
-                    ssh.close()
-                    print("SFTP connection closed")
-                except:
-                    pass
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                yield chunk
+        finally:
+            self.aborted.set()
+
+
+def sftp_sources(sftp, jobs):
+    """Yield (index, job, reader) for each job's file opened over SFTP, skipping vanished ones."""
+    for index, job in enumerate(jobs):
+        try:
+            remote_file = sftp.open(job.remote_path, 'rb')
+        except FileNotFoundError:
+            log(f"  {job.key} disappeared, skipping")
+            continue
+        with remote_file:
+            remote_file.prefetch(job.size)
+            yield index, job, remote_file
+
+
+def write_stream_zip(sftp, jobs, stream, written_routes, checksums):
+    """Producer side of the pipeline: copy each remote rlog into a zip written to `stream`."""
+    remote_hashes = None
+    if VERIFY_CHECKSUMS:
+        verify_pool = DaemonExecutor(max_workers=1, thread_name_prefix="verify")
+        remote_hashes = verify_pool.submit(remote_sha256, sftp, jobs)
+        verify_pool.shutdown(wait=False)
+    completed = {}
+    sources = tar_sources(sftp, jobs) if DOWNLOAD_TRANSPORT == "tar" else sftp_sources(sftp, jobs)
+    try:
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for index, job, remote_file in sources:
+                route_name, remote_rlog, remote_size, arcname = job.route, job.remote_path, job.size, job.key
+                log(f"[{index + 1}/{len(jobs)}] Streaming {arcname} ({remote_size / (1024 * 1024):.2f} MB)")
+                emit("segment_started", stage="stream", route=route_name, file=arcname, size=remote_size, resumed_from=0)
+                progress = ProgressEmitter("stream", arcname, remote_size)
+                start = time.monotonic()
+                head = remote_file.read(min(COMPRESSION_PROBE_BYTES, remote_size))
+                entry_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                entry_info.compress_type = choose_compression(head)
+                digest = hashlib.sha256(head)
+                with zipf.open(entry_info, 'w', force_zip64=True) as entry:
+                    entry.write(head)
+                    copied = len(head)
+                    while copied < remote_size:
+                        check_stopped()
+                        chunk = remote_file.read(min(DOWNLOAD_CHUNK_SIZE, remote_size - copied))
+                        if not chunk:
+                            raise IOError(f"{arcname} ended at {copied} of {remote_size} bytes")
+                        entry.write(chunk)
+                        digest.update(chunk)
+                        copied += len(chunk)
+                        progress.update(copied)
+                progress.update(copied, force=True)
+                completed[index] = (Path(remote_rlog), arcname, digest.hexdigest())
+                log(f"  {arcname} done in {time.monotonic() - start:.1f}s "
+                      f"({format_rate(remote_size, time.monotonic() - start)})")
+
+            # Corrupt segments are already in the archive, but leaving them
+            # unmarked makes the next cycle send them again.
+            corrupt, unverified = find_corrupt_downloads(remote_hashes, jobs, completed) if remote_hashes else ([], [])
+            for index in corrupt + unverified:
+                completed.pop(index)
+            for index in sorted(completed):
+                _, key, sha256 = completed[index]
+                written_routes.append(key)
+                checksums[key] = sha256
+        stream.close()
+    except (Exception, EngineStopped) as e:
+        # Abort the whole upload rather than finish an archive with a
+        # truncated segment in it.
+        written_routes.clear()
+        stream.fail(e)
+    finally:
+        sources.close()
+
+
+def stream_to_filebrowser(sftp, jobs, dongle_id, checksums=None, client=None):
+    """Download, zip and upload `jobs` in one pass without staging to disk.
+
+    Returns the routes contained in the uploaded archive, or an empty list if
+    the upload did not complete.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    zip_name = f"{dongle_id}-rlogs-{timestamp}.zip"
+    client = client or filebrowser
+    upload_url = f"{client.base_url}/api/resources{client.upload_path}{zip_name}"
+    total_size = sum(job.size for job in jobs)
+    log(f"\nStreaming {len(jobs)} rlogs ({total_size / (1024 * 1024):.2f} MB) into {zip_name}...")
+
+    stream = StreamBuffer(STREAM_BUFFER_CHUNKS, DOWNLOAD_CHUNK_SIZE)
+    written_routes = []
+    producer = threading.Thread(
+        target=write_stream_zip,
+        args=(sftp, jobs, stream, written_routes, {} if checksums is None else checksums),
+        daemon=True
+    )
+    with uplink_slots:
+        start = time.monotonic()
+        producer.start()
 
-                if not rlogs:
-                    print("\n✓ No new rlogs to upload!")
-                    print("Waiting for device to leave and return with new logs...")
+        try:
+            response = client.request(
+                "POST",
+                upload_url,
+                data=iter(stream),
+                retry_auth=False,
+                verify=False,
+                timeout=600
+            )
+        except Exception as e:
+            log_error(f"✗ Streaming upload error: {e}")
+            stream.aborted.set()
+            producer.join()
+            return []
+
+        stream.aborted.set()
+        producer.join()
+        elapsed = time.monotonic() - start
+    check_stopped()
+
+    finish_stage("stream", elapsed, bytes=total_size if written_routes else 0, segments=len(written_routes))
+    if response.status_code in [200, 201] and written_routes:
+        record_throughput(total_size, elapsed)
+        metrics.inc("rlog_stage_bytes_total", total_size, stage="stream")
+        log(f"✓ Upload complete! {len(written_routes)} rlogs in {elapsed:.1f}s "
+              f"({format_rate(total_size, elapsed)} end to end)")
+        log(f"URL: {client.base_url}{client.upload_path}{zip_name}")
+        return written_routes
+    log_error(f"✗ Streaming upload failed: {response.text[:200]}")
+    return []
+
+
+def scan_segments(sftp, uploaded_logs, deferred=None):
+    with timed_stage("scan"):
+        jobs = scan_new_rlogs(sftp, uploaded_logs, deferred)
+    metrics.inc("rlog_stage_bytes_total", sum(job.size for job in jobs), stage="scan")
+    return jobs
+
+
+def outbox_backoff(attempts):
+    return min(OUTBOX_RETRY_DELAY * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_MAX_DELAY)
+
+
+def archive_uploaded(store, dongle_id, zip_path, routes, seconds):
+    store.mark(dongle_id, routes, "uploaded")
+    store.record_upload(dongle_id, zip_path.name, len(routes), zip_path.stat().st_size, seconds)
+    store.outbox_remove(zip_path)
+    # FileBrowser holds the copy now; keeping this one would only grow OUTPUT_DIR
+    zip_path.unlink(missing_ok=True)
+    record_upload_offset(zip_path, None, None)
+    log(f"✓ {zip_path.name}: marked {len(routes)} routes as uploaded")
+
+
+def evict_outbox(store):
+    """Delete the oldest waiting archives while the outbox holds more than OUTBOX_MAX_BYTES."""
+    if OUTBOX_MAX_BYTES is None:
+        return
+    entries = store.outbox_entries()
+    total = sum(entry["size"] for entry in entries)
+    for entry in entries:
+        if total <= OUTBOX_MAX_BYTES:
+            break
+        if entry["next_attempt_at"] is None:
+            continue
+        zip_path = Path(entry["archive"])
+        zip_path.unlink(missing_ok=True)
+        store.outbox_remove(zip_path)
+        store.mark(entry["dongle_id"], entry["routes"], "seen")
+        total -= entry["size"]
+        log(f"Outbox over {OUTBOX_MAX_BYTES / (1024 ** 3):.1f} GB: deleted {zip_path.name}; "
+            f"its {len(entry['routes'])} routes will be downloaded again")
+
+
+def upload_outbox_entry(store, entry, client):
+    """Retry one claimed outbox archive, rescheduling it with backoff if it fails again."""
+    zip_path = Path(entry["archive"])
+    if not zip_path.exists():
+        log(f"Outbox archive {zip_path.name} is missing; its routes will be downloaded again")
+        store.outbox_remove(zip_path)
+        store.mark(entry["dongle_id"], entry["routes"], "seen")
+        return
+
+    log(f"\nOutbox: retrying {zip_path.name} (attempt {entry['attempts'] + 1})")
+    try:
+        if not login_filebrowser(client):
+            error = "login failed"
+        elif upload_parts([(zip_path, entry["routes"])],
+                          on_uploaded=lambda *part: archive_uploaded(store, entry["dongle_id"], *part),
+                          client=client):
+            error = "upload failed"
+        else:
+            return
+    except EngineStopped:
+        store.outbox_release(zip_path)
+        raise
+    delay = outbox_backoff(entry["attempts"] + 1)
+    store.outbox_retry_later(zip_path, delay, error)
+    log(f"Outbox: {zip_path.name} {error}, next try in {delay}s")
+
+
+def run_cycle(sftp, store, device=None):
+    """Scan, download, package and upload one batch from a connected device.
+
+    `device` supplies the FileBrowser account and receives the dongle ID;
+    without it the module-level settings are used. Returns False when the
+    batch could not be handed to FileBrowser and the device should be tried
+    again without waiting for it to leave.
+    """
+    client = device.filebrowser if device else filebrowser
+    dongle_id = get_dongle_id(sftp)
+    log(f"Dongle ID: {dongle_id}")
+    if device:
+        device.dongle_id = dongle_id
+
+    if dongle_id != "unknown":
+        # The legacy list belongs to the real dongle; importing it under
+        # "unknown" would rename the file and strand it there for good.
+        store.migrate_legacy_json(UPLOADED_LOGS_FILE, dongle_id)
+    uploaded_logs = store.settled_segments(dongle_id)
+    deferred = []
+    restore_throughput(store)
+
+    if STREAM_UPLOAD:
+        jobs = scan_segments(sftp, uploaded_logs, deferred)
+        if device:
+            device.deferred = len(deferred)
+        store.mark_seen(dongle_id, jobs)
+        jobs = schedule_jobs(jobs)
+        if not jobs:
+            log("\n✓ No new rlogs to upload!")
+            return True
+        if not login_filebrowser(client):
+            log("\nFailed to login to FileBrowser")
+            return False
+
+        checksums = {}
+        start = time.monotonic()
+        new_routes = stream_to_filebrowser(sftp, jobs, dongle_id, checksums, client)
+        seconds = time.monotonic() - start
+        save_throughput(store)
+        if not new_routes:
+            # Nothing is staged to retry from, so stream the batch again
+            return False
+
+        store.mark(dongle_id, new_routes, "uploaded", checksums=checksums)
+        streamed = set(new_routes)
+        store.record_upload(dongle_id, None, len(new_routes),
+                            sum(job.size for job in jobs if job.key in streamed), seconds)
+        log(f"✓ Marked {len(new_routes)} routes as uploaded")
+        log(f"Total uploaded routes: {store.count()}")
+        return True
+
+    # Separate per dongle so devices syncing at once never share a route directory
+    temp_dir = LOCAL_TEMP_DIR / dongle_id
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    jobs = scan_segments(sftp, uploaded_logs, deferred)
+    if device:
+        device.deferred = len(deferred)
+    store.mark_seen(dongle_id, jobs)
+    jobs = schedule_jobs(jobs)
+    checksums = {}
+    rlogs, new_routes = download_segments(sftp, jobs, temp_dir, checksums)
+    save_throughput(store)
+    store.mark(dongle_id, new_routes, "downloaded", checksums=checksums)
+
+    if not rlogs:
+        log("\n✓ No new rlogs to upload!")
+        return True
+
+    log(f"\n✓ Downloaded {len(rlogs)} new rlog files")
+
+    # Create zip parts
+    archives = create_zip_parts(rlogs, new_routes, dongle_id, OUTPUT_DIR)
+    for zip_path, part_routes in archives:
+        store.mark(dongle_id, part_routes, "packaged", archive=str(zip_path))
+        store.outbox_add(dongle_id, device.name if device else None, zip_path, part_routes)
+    evict_outbox(store)
+
+    # Upload to FileBrowser
+    if not login_filebrowser(client):
+        log("\nFailed to login to FileBrowser")
+        for zip_path, _ in archives:
+            store.outbox_retry_later(zip_path, outbox_backoff(1), "login failed")
+            log(f"Queued for retry: {zip_path}")
+        return False
 
-                    # Wait for device to disappear
-                    while ping_comma():
-                        time.sleep(5)
-                    print("\n✗ Comma 3X disconnected")
+    # Mark each part's routes as soon as that part lands
+    try:
+        failed = upload_parts(
+            archives,
+            on_uploaded=lambda *part: archive_uploaded(store, dongle_id, *part),
+            client=client
+        )
+    except EngineStopped:
+        # Parts that did not land go back to the outbox for the next run
+        for zip_path, _ in archives:
+            store.outbox_release(zip_path)
+        raise
+
+    if not failed:
+        log(f"\n✓ Upload successful!")
+    else:
+        for zip_path, _ in failed:
+            store.outbox_retry_later(zip_path, outbox_backoff(1), "upload failed")
+            log(f"\nUpload failed. Queued for retry: {zip_path}")
+    log(f"Total uploaded routes: {store.count()}")
+    return True
 
-                    continue
 
-                print(f"\n✓ Downloaded {len(rlogs)} new rlog files")
+class Device:
+    """A watched device: its SSH connection, FileBrowser account and progress."""
 
-                # Create zip
-                zip_path = create_zip(rlogs, dongle_id, OUTPUT_DIR, LOCAL_TEMP_DIR)
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+        self.connection = SSHConnection(
+            host=self.settings.get("host"),
+            username=self.settings.get("username"),
+            port=self.settings.get("port"),
+            key_filename=self.settings.get("key_filename")
+        )
+        self.filebrowser = FileBrowserClient(
+            base_url=self.settings.get("base_url"),
+            upload_path=self.settings.get("upload_path"),
+            username=self.settings.get("filebrowser_username"),
+            password=self.settings.get("filebrowser_password")
+        )
+        self.state = "waiting"
+        self.dongle_id = None
+        self.online_since = None
+        # Files the last cycle left for later because they were still being written
+        self.deferred = 0
+
+    @property
+    def host(self):
+        return self.settings.get("host") or COMMA_IP
+
+    @property
+    def port(self):
+        return self.settings.get("port") or COMMA_SSH_PORT
+
+    @property
+    def name(self):
+        return self.settings.get("name") or self.host
+
+    def set_online(self, online):
+        """Record presence; online time accrues between calls while the device is reachable."""
+        now = time.monotonic()
+        if self.online_since is not None:
+            metrics.inc("rlog_device_online_seconds_total", now - self.online_since, device=self.name)
+        self.online_since = now if online else None
+        metrics.set("rlog_device_online", int(online), device=self.name)
+
+    def progress(self, store):
+        line = f"[{self.name}] {self.state}"
+        if self.dongle_id:
+            counts = store.status_counts(self.dongle_id)
+            for status in SEGMENT_STATUSES:
+                metrics.set("rlog_device_segments", counts.get(status, 0), device=self.name, status=status)
+            line += f", {self.dongle_id}: " + ", ".join(f"{counts.get(s, 0)} {s}" for s in SEGMENT_STATUSES)
+            if len(FILE_TYPES) > 1:
+                uploaded = store.file_type_counts(self.dongle_id)
+                line += " (" + ", ".join(f"{uploaded.get(t['name'], 0)} {t['name']}" for t in FILE_TYPES) + ")"
+        return line
+
+
+def configured_devices():
+    return [Device(settings) for settings in DEVICES] or [Device()]
+
+
+async def watch_device(device, store, executor):
+    """Presence, sync and wait-to-leave loop for one device; blocking work runs on `executor`."""
+    loop = asyncio.get_running_loop()
+    # Set when the loop comes back to a device that has not left
+    rescan = False
+    while True:
+        device.state = "waiting"
+        latency = await wait_for_device(device)
+        if not rescan:
+            metrics.observe("rlog_presence_detect_seconds", latency, device=device.name)
+        rescan = False
+        device.set_online(True)
+
+        log(f"\n[{device.name}] Connecting to Comma 3X...")
 
-                # Upload to FileBrowser
-                token = login_filebrowser()
-                if not token:
-                    print("\nFailed to login to FileBrowser")
-                    print(f"Local file saved at: {zip_path}")
-                    time.sleep(60)
-                    continue
+        try:
+            device.state = "syncing"
+            sftp = await loop.run_in_executor(executor, device.connection.get_sftp)
+            log(f"[{device.name}] Connected!")
+
+            ok = await loop.run_in_executor(executor, run_cycle, sftp, store, device)
+            device.set_online(True)
+            if not ok:
+                # Login or streamed upload failed; try the batch again shortly
+                emit("error", message="FileBrowser upload failed, retrying in 60s", device=device.name)
+                metrics.inc("rlog_cycles_total", result="upload_failed")
+                device.state = "upload failed"
+                await asyncio.sleep(60)
+                device.set_online(False)
+                rescan = True
+                continue
+            metrics.inc("rlog_cycles_total", result="ok")
+            device.state = "done"
+            log(device.progress(store))
+
+            if device.deferred:
+                # The car is on: sync each segment as openpilot finishes it
+                device.state = "waiting for segment"
+                log(f"\n[{device.name}] {device.deferred} files still being written, "
+                    f"checking again in {SEGMENT_SETTLE_SECONDS}s...")
+                await asyncio.sleep(SEGMENT_SETTLE_SECONDS)
+                # Online time resumes once wait_for_device sees it again
+                device.set_online(False)
+                rescan = True
+                continue
 
-                upload_url = upload_to_filebrowser(token, zip_path)
+            # Wait for device to leave before checking again
+            log(f"\n[{device.name}] Waiting for device to leave...")
+            await wait_for_device_to_leave(device)
+            device.set_online(False)
+            device.connection.close()
 
-                if upload_url:
-                    print(f"\n✓ Upload successful!")
-                    # Mark these routes as uploaded
-                    uploaded_logs.update(new_routes)
-                    save_uploaded_logs(uploaded_logs)
-                    print(f"✓ Marked {len(new_routes)} routes as uploaded")
-                    print(f"Total uploaded routes: {len(uploaded_logs)}")
-                else:
-                    print(f"\nUpload failed. Local file saved at: {zip_path}")
+        except Exception as e:
+            log_error(f"\n[{device.name}] Error: {e}", device=device.name)
+            metrics.inc("rlog_cycles_total", result="error")
+            device.state = "error"
+            device.set_online(False)
+            device.connection.close()
+            await asyncio.sleep(30)
+
+
+async def drain_outbox(devices, store, executor):
+    """Retry outbox archives as they come due, whether or not any device is online."""
+    loop = asyncio.get_running_loop()
+    clients = {device.name: device.filebrowser for device in devices}
+    while True:
+        while True:
+            entry = store.outbox_claim_next()
+            if entry is None:
+                break
+            client = clients.get(entry["device"], filebrowser)
+            await loop.run_in_executor(executor, upload_outbox_entry, store, entry, client)
+        entries = store.outbox_entries()
+        metrics.set("rlog_queue_depth", len(entries), queue="outbox")
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+async def report_progress(devices, store, write_metrics=False):
+    """Print the progress of syncing devices every METRICS_WRITE_INTERVAL, and write METRICS_FILE if asked."""
+    while True:
+        await asyncio.sleep(METRICS_WRITE_INTERVAL)
+        for device in devices:
+            device.set_online(device.online_since is not None)
+            line = device.progress(store)
+            if device.state == "syncing":
+                log(line)
+        if not write_metrics:
+            continue
+        try:
+            metrics.write()
+        except Exception as e:
+            log(f"Warning: Failed to write metrics: {e}")
+
+
+async def watch_config(devices):
+    while True:
+        await asyncio.sleep(CONFIG_POLL_INTERVAL)
+        refresh_config(devices)
+
+
+class DaemonExecutor(Executor):
+    """A thread pool whose workers are daemon threads.
+
+    ThreadPoolExecutor joins its workers at interpreter exit, so a download
+    or upload in progress would hold up Ctrl+C; these threads are abandoned
+    instead. Without `max_workers` every call gets a thread of its own.
+    shutdown(wait=True) still waits for the running calls.
+    """
+
+    def __init__(self, max_workers=None, thread_name_prefix="worker"):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.work = []
+        self.threads = set()
+        self.lock = threading.Lock()
+        self.started = 0
+        self.closed = False
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self.work.append((future, fn, args, kwargs))
+            if self.max_workers is not None and len(self.threads) >= self.max_workers:
+                return future
+            thread = threading.Thread(target=self._worker, name=f"{self.thread_name_prefix}_{self.started}", daemon=True)
+            self.started += 1
+            self.threads.add(thread)
+        thread.start()
+        return future
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                if not self.work:
+                    # Checked under the lock, so submit() starts a new worker for anything queued after this
+                    self.threads.discard(threading.current_thread())
+                    return
+                future, fn, args, kwargs = self.work.pop(0)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.lock:
+            self.closed = True
+            if cancel_futures:
+                for future, *_ in self.work:
+                    future.cancel()
+                self.work.clear()
+            threads = list(self.threads)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+async def run_engine(devices, store, write_metrics=False, drain=True):
+    """Watch all devices concurrently; each device's cycle runs in its own worker thread.
+
+    `write_metrics` keeps METRICS_FILE up to date for a standalone run; a
+    hosting program renders `metrics` itself. With `drain`, returning waits
+    for in-flight cycles to stop; without it they are abandoned, which lets
+    an interrupted standalone run exit at once.
+    """
+    refresh_config(devices, force=True)
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, refresh_config, devices, True)
+    except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+        # No SIGHUP on Windows, and only the main thread may install handlers
+        pass
+    stop_requested.clear()
+    store.outbox_release_all()
+    # Each device and the outbox retries run one call at a time
+    executor = DaemonExecutor(thread_name_prefix="device")
+    try:
+        await asyncio.gather(
+            report_progress(devices, store, write_metrics),
+            watch_config(devices),
+            drain_outbox(devices, store, executor),
+            *(watch_device(device, store, executor) for device in devices)
+        )
+    finally:
+        # Cycles stop at their next chunk; wait for them so a restarted
+        # engine never races a worker left over from this one.
+        stop_requested.set()
+        for device in devices:
+            device.connection.close()
+        executor.shutdown(wait=drain)
+
+
+class Engine:
+    """Runs run_engine on a background thread for a program hosting the downloader.
+
+    While running, every event goes to `events`, a queue the host drains on
+    its own thread. stop() cancels the engine; the engine counts as running
+    until its in-flight cycles have stopped at their next chunk.
+    """
+
+    def __init__(self, devices=None, store=None):
+        self.devices = devices
+        self.store = store
+        self.events = queue.Queue(ENGINE_EVENT_QUEUE_SIZE)
+        self.thread = None
+        self.loop = None
+        self.task = None
+        self.ready = threading.Event()
+
+    def put_event(self, event):
+        if event["type"] == "bytes_progress":
+            try:
+                self.events.put_nowait(event)
+            except queue.Full:
+                pass
+        else:
+            self.events.put(event)
 
-                # Wait for device to leave before checking again
-                print("\nWaiting for device to leave...")
-                while ping_comma():
-                    time.sleep(5)
-                print("\n✗ Comma 3X disconnected")
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
 
-            except Exception as e:
-                print(f"\nError: {e}")
-                time.sleep(30)
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="rlog-engine", daemon=True)
+        self.thread.start()
+        self.ready.wait()
 
+    def run(self):
+        event_handlers.append(self.put_event)
+        try:
+            store = self.store or SegmentStore(STATE_DB_FILE)
+            self.devices = devices = self.devices or configured_devices()
+            log(f"Loaded state database: {store.count()} routes already uploaded\n")
+            if len(devices) > 1:
+                log(f"Watching {len(devices)} devices: {', '.join(device.name for device in devices)}\n")
+            asyncio.run(self.main(devices, store))
+        except asyncio.CancelledError:
+            log("\nStopped")
+        except Exception as e:
+            log_error(f"\nEngine stopped: {e}")
+        finally:
+            self.ready.set()
+            event_handlers.remove(self.put_event)
+            self.events.put(None)
+
+    async def main(self, devices, store):
+        self.loop = asyncio.get_running_loop()
+        self.task = asyncio.current_task()
+        self.ready.set()
+        await run_engine(devices, store)
+
+    def reload_config(self):
+        """Apply config.json now rather than at the next poll."""
+        if self.loop and self.is_running():
+            self.loop.call_soon_threadsafe(refresh_config, self.devices, True)
+
+    def stop(self, timeout=10):
+        if self.loop and self.task and self.is_running():
+            self.loop.call_soon_threadsafe(self.task.cancel)
+        if self.thread:
+            self.thread.join(timeout)
+
+
+if __name__ == "__main__":
+    log("=" * 60)
+    log("Comma 3X Rlog Auto-Uploader")
+    log("=" * 60)
+    log("Monitoring for new logs and auto-uploading...")
+    log("Press Ctrl+C to stop\n")
+
+    store = SegmentStore(STATE_DB_FILE)
+    log(f"Loaded state database: {store.count()} routes already uploaded\n")
+    devices = configured_devices()
+    if len(devices) > 1:
+        log(f"Watching {len(devices)} devices: {', '.join(device.name for device in devices)}\n")
+
+    try:
+        asyncio.run(run_engine(devices, store, write_metrics=True, drain=False))
     except KeyboardInterrupt:
-        print("\n\nStopped by user")
-        print(f"Total routes uploaded: {len(uploaded_logs)}")
\ No newline at end of file
+        log("\n\nStopped by user")
+        log(f"Total routes uploaded: {store.count()}")